@@ -14,21 +14,20 @@ See <https://github.com/trentm/nodedoc> for more info.
 __version_info__ = (1, 3, 2)
 __version__ = '.'.join(map(str, __version_info__))
 
+import time
+# When this module started loading (for `--profile`).
+_start_time = time.time()
 import re
 import sys
-import textwrap
 import os
 from os.path import dirname, join, exists, splitext, basename, realpath
 import logging
 import codecs
-import optparse
-import bisect
+import json
 from glob import glob
-from pprint import pprint
 
 TOP = dirname(dirname(realpath(__file__)))
 sys.path.insert(0, join(TOP, "deps"))
-import markdown2
 import appdirs
 
 
@@ -37,6 +36,8 @@ import appdirs
 
 log = logging.getLogger("nodedoc")
 CACHE_DIR = appdirs.user_cache_dir("nodedoc", "trentm")
+# Rendered docs shipped with the package (see `prebuild()`).
+PREBUILT_DIR = join(TOP, "prebuilt")
 
 def _get_doc_versions():
     import re
@@ -54,7 +55,9 @@ def _get_doc_versions():
         f.close()
     versions.sort()
     return versions
+_t = time.time()
 DOC_VERSIONS = _get_doc_versions()
+_doc_versions_time = time.time() - _t
 
 # Default node version of docs: just the minor ver number (as a string).
 DEFAULT_V = str(sorted(DOC_VERSIONS)[-1][1])
@@ -88,177 +91,647 @@ def inverse(text):
 
 
 
-#---- re.sub transformers
+#---- rendering of markdown2's HTML to ANSI-styled text
 
-def indent(match):
-    INDENT = '    '
-    text = match.group(1)
-    after = INDENT + INDENT.join(text.splitlines(True))
-    #print "XXX hit: after=%r" % after
-    return after
+# Block-level tokens. Everything between these tokens is inline text. HTML
+# comments on their own line (with their leading newline) are dropped, as
+# are the newlines just outside a list.
+_block_token_re = re.compile(r"""
+    (?P<comment>\n?<!--.*?-->\n)
+    |<pre><code>(?P<pre_code>.*?)</code></pre>
+    |<code>(?P<code>.*?)</code>
+    |\n?<(?P<list>ul|ol)>
+    |</(?P<end_list>ul|ol)>\n?
+    |<(?P<end>/?)(?P<tag>pre|li|p|h[1-4])>
+    """, re.S | re.X)
 
-def code(match):
+# Inline tokens. These are rendered last, after paragraphs are reflowed.
+_inline_token_re = re.compile(r"""
+    <(?P<a>a)(?:\s[^>]*)?>
+    |<(?P<tag>em|strong)>
+    |</(?P<end>a|em|strong)>
+    |&(?P<entity>gt|lt|amp);
+    """, re.X)
+_entities = {"gt": ">", "lt": "<", "amp": "&"}
+_entity_re = re.compile(r"&(gt|lt|amp);")
+
+def _unescape_entities(text):
+    return _entity_re.sub(lambda match: _entities[match.group(1)], text)
+
+def _code(text):
     """green. Special case grey for "Stability: ..." pre-blocks."""
-    text = match.group(1)
     styler = green
     if text.startswith("Stability:"):
         styler = grey
-    lines = [
-        styler(line)
-        for line in text.splitlines(False)
-    ]
-    return '\n'.join(lines)
+    return '\n'.join(styler(line) for line in text.splitlines(False))
 
-def wrap(match, width=80):
-    """XXX TODO: somehow make the ANSI escapes zero-length for width
-    calculation."""
-    text = match.group(1)
-    text = '\n'.join(textwrap.wrap(text, width=width))
-    return text
+def _indent(text, indent='    '):
+    return indent + indent.join(text.splitlines(True))
 
-def h1(match):
-    """bold red"""
-    text = match.group(1)
-    return bold(red('# ' + text))
-    return '\n'.join(lines)
+# An ANSI SGR escape, as output by the stylers above.
+_sgr_re = re.compile(r"\033\[(\d+)m")
 
-def h2(match):
-    """bold red, extra leading space"""
-    text = match.group(1)
-    text = '\n' + bold(red('## ' + text))
-    return text
+# The SGR code that turns off each styling code. Colors are all turned off
+# by "39".
+_sgr_off = {"1": "22", "3": "23", "7": "27"}
+_sgr_off_codes = set(["22", "23", "27", "39"])
 
-def h3(match):
-    """bold red"""
-    text = match.group(1)
-    text = '\n' + bold(red('### ' + text))
-    return text
+# Whitespace that is reflowed as a space, and the split of text into words
+# and runs of whitespace.
+_wrap_whitespace_re = re.compile('[\t\n\x0b\x0c\r]')
+_wrap_chunk_re = re.compile(r"(\s+)", re.U)
 
-def h4(match):
-    """bold red"""
-    text = match.group(1)
-    text = '\n' + bold(red('#### ' + text))
-    return text
+def _visible_len(text):
+    if '\033' not in text:
+        return len(text)
+    return len(_sgr_re.sub('', text))
 
-def a(match):
-    """blue"""
-    text = match.group(1)
-    lines = [
-        '\033[34m' + line + '\033[39m'
-        for line in text.splitlines(False)
-    ]
+def _split_visible(text, n):
+    """Split `text` after its first `n` visible characters, keeping any
+    escapes that directly follow them in the first part.
+    """
+    i = count = 0
+    while i < len(text):
+        match = _sgr_re.match(text, i)
+        if match:
+            i = match.end()
+        elif count == n:
+            break
+        else:
+            i += 1
+            count += 1
+    return text[:i], text[i:]
+
+def _restyle_lines(lines):
+    """Close the styles still open at the end of each line, and reopen them
+    at the start of the next, so that each line is styled on its own.
+    """
+    result = []
+    active = []  # the styling codes in effect, in the order turned on
+    for line in lines:
+        prefix = ''.join('\033[%sm' % code for code in active)
+        for code in _sgr_re.findall(line):
+            if code in _sgr_off_codes:
+                active = [c for c in active if _sgr_off.get(c, "39") != code]
+            else:
+                active.append(code)
+        suffix = ''.join('\033[%sm' % _sgr_off.get(code, "39")
+            for code in reversed(active))
+        result.append(prefix + line + suffix)
+    return result
+
+def _wrap(text, width):
+    """Reflow the given (inline rendered) text to lines of at most `width`
+    visible characters.
+
+    As with `textwrap.wrap`, whitespace is kept within lines but dropped
+    at line breaks, and a word longer than `width` is broken. ANSI escapes
+    take no width and are never broken.
+    """
+    chunks = _wrap_chunk_re.split(
+        _wrap_whitespace_re.sub(' ', text.expandtabs()))
+    lines = []
+    line = []
+    line_len = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        n = _visible_len(chunk)
+        if chunk.isspace():
+            if line or not lines:
+                line.append(chunk)
+                line_len += n
+            continue
+        if line_len + n > width:
+            if line and line[-1].isspace():
+                line.pop()
+            if line:
+                lines.append(''.join(line))
+            line = []
+            line_len = 0
+            while n > width:
+                head, chunk = _split_visible(chunk, width)
+                lines.append(head)
+                n -= width
+        line.append(chunk)
+        line_len += n
+    if line and line[-1].isspace():
+        line.pop()
+    if line:
+        lines.append(''.join(line))
+    if '\033' in text:
+        lines = _restyle_lines(lines)
     return '\n'.join(lines)
 
-def em(match):
+def _a(text):
+    """blue"""
+    return '\n'.join('\033[34m' + line + '\033[39m'
+        for line in text.splitlines(False))
+
+def _em(text):
     """cyan"""
-    text = match.group(1)
     lines = [cyan(line) for line in text.splitlines(False)]
     return cyan('*') + '\n'.join(lines) + cyan('*')
 
-def strong(match):
+def _strong(text):
     """bold cyan"""
-    text = match.group(1)
     lines = [bold(cyan(line)) for line in text.splitlines(False)]
     return bold(cyan('**')) + '\n'.join(lines) + bold(cyan('**'))
 
-def li(match):
-    """bullet and indent and reflow"""
-    text = match.group(1)
-    text = '\n'.join(textwrap.wrap(text, width=78))
-    INDENT = '  '
-    text = INDENT + INDENT.join(text.splitlines(True))
-    text = '-' + text[1:]
+_inline_stylers = {"a": _a, "em": _em, "strong": _strong}
+
+def _header(tag, text):
+    """bold red, extra leading space for all but h1"""
+    level = int(tag[1])
+    text = bold(red('#' * level + ' ' + text))
+    if level > 1:
+        text = '\n' + text
     return text
 
-def noop(match):
-    return match.group(1)
+def render_inline(text):
+    """Render inline markup (links, em, strong and the HTML escapes) in
+    the given text in one pass. Unbalanced tags are left as is.
+    """
+    if '<' not in text and '&' not in text:
+        return text
+    parts = []
+    stack = []  # (<tag>, <open tag text>, <parts before the tag>)
+    pos = 0
+    for match in _inline_token_re.finditer(text):
+        parts.append(text[pos:match.start()])
+        pos = match.end()
+        entity = match.group("entity")
+        if entity:
+            parts.append(_entities[entity])
+            continue
+        end = match.group("end")
+        if end is None:
+            tag = match.group("a") or match.group("tag")
+            stack.append((tag, match.group(0), parts))
+            parts = []
+        elif stack and stack[-1][0] == end:
+            content = ''.join(parts)
+            parts = stack.pop()[2]
+            parts.append(_inline_stylers[end](content))
+        else:
+            parts.append(match.group(0))
+    parts.append(text[pos:])
+    while stack:
+        tag, open_tag, outer_parts = stack.pop()
+        outer_parts.append(open_tag)
+        outer_parts += parts
+        parts = outer_parts
+    return ''.join(parts)
+
+class _Block(object):
+    """An open block element while rendering.
+
+    `parts` holds the block's content as a list of `(<is-block>, <text>)`:
+    runs of raw (not yet inline rendered) text, and the output of its
+    already rendered child blocks. Each block renders the inline markup in
+    its own text before laying it out, so that paragraphs are reflowed by
+    visible width. For list items, paragraphs and nested lists are laid
+    out separately.
+    """
+    def __init__(self, tag, width, marker=None):
+        self.tag = tag
+        self.width = width
+        self.marker = marker
+        self.parts = []
+        self.count = 0  # number of items in an <ol>
+
+    def add_text(self, text):
+        if self.parts and not self.parts[-1][0]:
+            self.parts[-1] = (False, self.parts[-1][1] + text)
+        else:
+            self.parts.append((False, text))
+
+    def add_block(self, text):
+        self.parts.append((True, text))
+
+    def render(self):
+        tag = self.tag
+        if tag == "li":
+            return self._render_li()
+        content = ''.join([is_block and text or render_inline(text)
+            for is_block, text in self.parts])
+        if tag == "pre":
+            return _indent(content)
+        elif tag == "p":
+            # reflow to the available width (80 columns at the top level)
+            return _wrap(content, self.width)
+        elif tag in (None, "ul", "ol"):
+            return content
+        else:  # h1-h4
+            return _header(tag, content)
+
+    def _render_li(self):
+        """Bullet (or number), indent and reflow a list item. Paragraphs
+        and nested lists in the item are indented to line up with it.
+        """
+        lines = []
+        blank = False
+        for is_block, text in self.parts:
+            if not is_block:
+                if not text.strip():
+                    blank = blank or text.count('\n') > 1
+                    continue
+                text = _wrap(render_inline(text), self.width)
+            text = text.strip('\n')
+            if lines and blank:
+                lines.append('')
+            lines += text.split('\n')
+            blank = False
+        if not lines:
+            lines = ['']
+        indent = ' ' * len(self.marker)
+        return '\n'.join([self.marker + lines[0]]
+            + [line and indent + line for line in lines[1:]])
+
+def render_nodedoc(html, width=80):
+    """Render markdown2's HTML for a node.js doc section as text colored
+    with ANSI escapes, in a single walk over the document.
+    """
+    stack = [_Block(None, width)]
+    pos = 0
+    for match in _block_token_re.finditer(html):
+        if match.start() > pos:
+            stack[-1].add_text(html[pos:match.start()])
+        pos = match.end()
+        if match.group("comment"):
+            continue
+        code = match.group("code")
+        if code is not None:
+            stack[-1].add_text(_code(code))
+            continue
+        code = match.group("pre_code")
+        if code is not None:
+            stack[-1].add_block(_indent(_code(_unescape_entities(code))))
+            continue
+        list_tag = match.group("list")
+        if list_tag:
+            stack.append(_Block(list_tag, stack[-1].width))
+            continue
+        tag = match.group("end_list") or match.group("tag")
+        if match.group("end_list") or match.group("end"):
+            if tag not in [b.tag for b in stack[1:]]:
+                stack[-1].add_text(match.group(0))
+                continue
+            while True:
+                block = stack.pop()
+                stack[-1].add_block(block.render())
+                if block.tag == tag:
+                    break
+        elif tag == "li":
+            parent = stack[-1]
+            if parent.tag == "ol":
+                parent.count += 1
+                marker = "%d. " % parent.count
+            else:
+                marker = "- "
+            stack.append(_Block(tag, parent.width - len(marker), marker))
+        else:
+            stack.append(_Block(tag, stack[-1].width))
+    if pos < len(html):
+        stack[-1].add_text(html[pos:])
+    while len(stack) > 1:
+        block = stack.pop()
+        stack[-1].add_block(block.render())
+    return stack[0].render()
 
 
 
 #---- main nodedoc functionality
 
-def generate_html_path(markdown_path, html_path):
-    if not exists(dirname(html_path)):
-        os.makedirs(dirname(html_path))
-    html = markdown2.markdown_path(markdown_path)
-    codecs.open(html_path, 'w', 'utf-8').write(html)
+# The markdown2 converter for the sections built in this process. It is
+# reset for each section.
+_markdowner = None
 
-def generate_nodedoc_path(html_path, nodedoc_path):
-    if not exists(dirname(nodedoc_path)):
-        os.makedirs(dirname(nodedoc_path))
+def generate_nodedoc_path(markdown_path, nodedoc_path, html_path=None,
+        timings=None):
+    """Render the given markdown doc section to a .nodedoc file.
 
-    content = codecs.open(html_path, 'r', 'utf-8').read()
+    The markdown is converted to HTML and rendered in memory. Only the
+    .nodedoc file is written unless `html_path` is given (for debugging
+    the renderer), in which case the intermediate HTML is saved there.
 
-    # html comments: drop
-    content = re.compile('\n?<!--(.*?)-->\n', re.S).sub('', content)
+    @param timings {dict} If given, the time spent in each markdown2
+        stage (see `markdown2.Markdown.record_timings()`), rendering and
+        writing is added to it.
+    @returns {dict} The cache manifest entry for the markdown source.
+    """
+    global _markdowner
+    if _markdowner is None:
+        import markdown2
+        _markdowner = markdown2.Markdown()
+    st = os.stat(markdown_path)
+    f = open(markdown_path, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    if timings is not None:
+        _markdowner.record_timings(timings)
+    try:
+        html = _markdowner.convert(data.decode('utf-8'))
+    finally:
+        _markdowner.timings = None
+    if html_path:
+        _write_file_atomic(html_path, html.encode('utf-8'))
+    start = time.time()
+    content = render_nodedoc(html)
+    if timings is not None:
+        _add_timing(timings, "render_nodedoc", time.time() - start)
+        start = time.time()
+    _write_file_atomic(nodedoc_path, content.encode('utf-8'))
+    if timings is not None:
+        _add_timing(timings, "write", time.time() - start)
+    return {"size": len(data), "mtime": st.st_mtime,
+        "digest": _digest(data)}
+
+def doc_version_from_v(v=DEFAULT_V):
+    """Return the full node version string of the given doc tree, e.g.
+    "0.10.0" for "10", or None if it isn't listed in "doc/versions".
+    """
+    for ver in DOC_VERSIONS:
+        if str(ver[1]) == v:
+            return ".".join(map(str, ver))
+    return None
 
-    # code:
-    content = re.compile('<code>(.*?)</code>', re.S).sub(code, content)
+def cache_dir_from_v(v=DEFAULT_V):
+    """Return the cache dir for the given doc tree.
 
-    # pre: indent
-    content = re.compile('<pre>(.*?)</pre>', re.S).sub(indent, content)
+    Each doc tree is cached in its own dir, named for its node version
+    (e.g. "v0.10.0"), so that switching between trees doesn't rebuild
+    anything. It also means an updated tree never reuses the cache of an
+    older one.
 
-    # li: bullet
-    # XXX how to know in ol? AFAICT only one <ol> in node.js docs, so ignoring for now.
-    # XXX does this mess up multi-para li?
-    content = re.compile('<li>(?:<p>)?(.*?)(?:</p>)?</li>', re.S).sub(li, content)
-    # ol, ul: ignore
-    content = re.compile('\n?<ul>(.*?)</ul>\n', re.S).sub(noop, content)
-    content = re.compile('\n?<ol>(.*?)</ol>\n', re.S).sub(noop, content)
+    If the package ships a prebuilt cache for the tree (see
+    `prebuild()`) then that is used, until one of its sources changes.
+    """
+    cache_dir = _cache_dirs.get(v)
+    if cache_dir is None:
+        ver = doc_version_from_v(v)
+        if ver:
+            name = "v" + ver
+        else:
+            name = "api" + v
+        cache_dir = join(PREBUILT_DIR, name)
+        if not exists(join(cache_dir, "manifest-%s.json" % __version__)):
+            cache_dir = join(CACHE_DIR, name)
+        _cache_dirs[v] = cache_dir
+    return cache_dir
 
-    # p: wrap content at 80 columns
-    content = re.compile('<p>(.*?)</p>', re.S).sub(wrap, content)
+# Cache dir in use for each doc tree: {<v>: <cache dir>}
+_cache_dirs = {}
 
-    # a: drop attrs (until/unless have a way to follow those links)
-    content = re.compile('<a[^>]*>(.*?)</a>', re.S).sub(a, content)
+def _using_prebuilt(v=DEFAULT_V):
+    return dirname(cache_dir_from_v(v)) == PREBUILT_DIR
 
-    content = re.compile('<em>(.*?)</em>', re.S).sub(em, content)
-    content = re.compile('<strong>(.*?)</strong>', re.S).sub(strong, content)
+def _fall_back_from_prebuilt(v=DEFAULT_V):
+    """Switch the given doc tree from the prebuilt cache, if that is in
+    use, to the user cache dir.
 
-    # hN: highlight, but how to highlight different levels?
-    content = re.compile('<h1>(.*?)</h1>', re.S).sub(h1, content)
-    content = re.compile('<h2>(.*?)</h2>', re.S).sub(h2, content)
-    content = re.compile('<h3>(.*?)</h3>', re.S).sub(h3, content)
-    content = re.compile('<h4>(.*?)</h4>', re.S).sub(h4, content)
+    @returns {bool} True if the tree was switched.
+    """
+    if not _using_prebuilt(v):
+        return False
+    cache_dir = join(CACHE_DIR, basename(cache_dir_from_v(v)))
+    log.debug("prebuilt docs are out of date, use '%s'", cache_dir)
+    _cache_dirs[v] = cache_dir
+    return True
+
+def _v_from_markdown_path(markdown_path):
+    """The doc tree for a "doc/api<v>/<section>.markdown" path."""
+    return basename(dirname(markdown_path))[len("api"):]
+
+def nodedoc_path_from_section(section, v=DEFAULT_V):
+    return join(cache_dir_from_v(v), "%s-%s.nodedoc" % (section, __version__))
+
+def markdown_path_from_section(section, v=DEFAULT_V):
+    return join(TOP, "doc", "api"+v, section + ".markdown")
+
+def markdown_paths_from_v(v=DEFAULT_V):
+    """The markdown sources of the given doc tree."""
+    return glob(join(TOP, "doc", "api"+v, "*.markdown"))
+
+def manifest_path(v=DEFAULT_V):
+    return join(cache_dir_from_v(v), "manifest-%s.json" % __version__)
+
+def load_manifest(v=DEFAULT_V):
+    """Load the cache manifest for the given doc tree.
+
+    The manifest records, for each section, the size, mtime and digest of
+    the markdown source that its .nodedoc file was built from. A source
+    whose size and mtime match is taken as unchanged without reading it.
+    Otherwise its digest decides, so cache validity survives things
+    that reset mtimes (`npm install`, rsync, container layers).
+    """
+    try:
+        f = open(manifest_path(v), 'r')
+        try:
+            manifest = json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        manifest = None
+    if not manifest or manifest.get("version") != __version__:
+        manifest = {"version": __version__, "sources": {}}
+    return manifest
+
+def save_manifest(manifest, v=DEFAULT_V):
+    _write_file_atomic(manifest_path(v), json.dumps(manifest))
+
+def _digest(data):
+    import hashlib
+    return hashlib.sha1(data).hexdigest()
+
+def _file_digest(path):
+    f = open(path, 'rb')
+    try:
+        return _digest(f.read())
+    finally:
+        f.close()
+
+def _tree_digest(manifest):
+    """A digest of all the sources listed in the manifest."""
+    return _digest(''.join("%s %s\n" % (section, entry["digest"])
+        for section, entry in sorted(manifest["sources"].items())))
 
-    #TODO:XXX special case two adjacent h2's, e.g.:
-    #
-    #    <h2>fs.utimes(path, atime, mtime, [callback])</h2>
-    #
-    #    <h2>fs.utimesSync(path, atime, mtime)</h2>
-    #
-    #    <p>Change file timestamps of the file referenced by the supplied path.</p>
+def _check_manifest_entry(manifest, markdown_path):
+    """Return True iff the manifest entry for the given markdown source is
+    up to date. The entry's mtime is updated if only that changed.
+    """
+    section = splitext(basename(markdown_path))[0]
+    entry = manifest["sources"].get(section)
+    if entry is None:
+        return False
+    st = os.stat(markdown_path)
+    if st.st_size != entry["size"]:
+        return False
+    elif st.st_mtime == entry["mtime"]:
+        return True
+    elif _file_digest(markdown_path) == entry["digest"]:
+        entry["mtime"] = st.st_mtime
+        manifest["dirty"] = True
+        return True
+    else:
+        return False
 
-    # HTML escapes
-    content = content \
-        .replace('&gt;', '>') \
-        .replace('&lt;', '<') \
-        .replace('&amp;', '&')
+def build_nodedoc(markdown_path, timings=None):
+    """Build the .nodedoc file for the given markdown path.
 
-    codecs.open(nodedoc_path, 'w', 'utf-8').write(content)
+    @param timings {dict} If given, the time spent in each stage of
+        building is added to it (see `generate_nodedoc_path()`).
+    @returns {dict} The cache manifest entry for the markdown source.
+    """
+    section = splitext(basename(markdown_path))[0]
+    v = _v_from_markdown_path(markdown_path)
+    nodedoc_path = nodedoc_path_from_section(section, v)
+    html_path = None
+    if os.environ.get("NODEDOC_KEEP_HTML"):
+        html_path = join(cache_dir_from_v(v), section + ".html")
+    log.debug("build %s", nodedoc_path)
+    return generate_nodedoc_path(markdown_path, nodedoc_path, html_path,
+        timings)
+
+def _build_nodedoc_in_worker(args):
+    markdown_path, timed = args
+    timings = None
+    if timed:
+        timings = {}
+    return build_nodedoc(markdown_path, timings), timings
 
 def ensure_nodedoc_built(markdown_path):
     if not exists(markdown_path):
         raise OSError("markdown path does not exist: '%s'" % markdown_path)
 
     section = splitext(basename(markdown_path))[0]
-    html_path = join(CACHE_DIR, section + ".html")
-    if not exists(html_path) or mtime(html_path) < mtime(markdown_path):
-        generate_html_path(markdown_path, html_path)
-
-    nodedoc_path = join(CACHE_DIR, "%s-%s.nodedoc" % (section, __version__))
-    if not exists(nodedoc_path) or mtime(nodedoc_path) < mtime(html_path):
-        generate_nodedoc_path(html_path, nodedoc_path)
-
+    v = _v_from_markdown_path(markdown_path)
+    nodedoc_path = nodedoc_path_from_section(section, v)
+    manifest = load_manifest(v)
+    if (not _check_manifest_entry(manifest, markdown_path)
+        or not exists(nodedoc_path)):
+        if _fall_back_from_prebuilt(v):
+            return ensure_nodedoc_built(markdown_path)
+        manifest["sources"][section] = build_nodedocs([markdown_path])[0]
+        manifest["dirty"] = True
+    if manifest.pop("dirty", False) and not _using_prebuilt(v):
+        save_manifest(manifest, v)
     return nodedoc_path
 
-def ensure_nodedocs_built(v=DEFAULT_V):
+def default_jobs():
+    """The number of worker processes to use for building sections.
+
+    This is `NODEDOC_JOBS` from the environment, if set, else the number
+    of CPUs.
+    """
+    jobs = os.environ.get("NODEDOC_JOBS")
+    if jobs:
+        return int(jobs)
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def _init_worker():
+    # Leave Ctrl-C to the parent process, which terminates the pool.
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# How long to wait for a pool of workers to build (in seconds).
+_POOL_TIMEOUT = 24 * 60 * 60
+
+def build_nodedocs(markdown_paths, jobs=None):
+    """Build the .nodedoc files for the given markdown paths, which can be
+    from more than one doc tree.
+
+    Sections are built in parallel over a pool of worker processes, each
+    of which reuses one markdown2 converter for the sections it builds.
+    With debug logging (`nodedoc -v`) or `--profile`, the time spent in
+    each stage of building (markdown2's stages, rendering and writing)
+    over all the sections is logged or profiled.
+
+    @param jobs {int} The number of worker processes to use. If not
+        given, `default_jobs()` is used. Use 1 to build serially.
+    @returns {list} The cache manifest entry for each markdown source.
+    """
+    if not markdown_paths:
+        return []
+    if jobs is None:
+        jobs = default_jobs()
+    jobs = min(jobs, len(markdown_paths))
+    timings = None
+    if log.isEnabledFor(logging.DEBUG) or _profile is not None:
+        timings = {}
+    if jobs <= 1:
+        entries = [build_nodedoc(p, timings) for p in markdown_paths]
+    else:
+        import multiprocessing
+        log.debug("build %d sections with %d workers",
+            len(markdown_paths), jobs)
+        pool = multiprocessing.Pool(jobs, _init_worker)
+        try:
+            # Wait with a timeout: on Python 2 a plain `map()` doesn't
+            # deliver KeyboardInterrupt until all the work is done.
+            results = pool.map_async(_build_nodedoc_in_worker,
+                [(p, timings is not None) for p in markdown_paths]
+                ).get(_POOL_TIMEOUT)
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+        entries = []
+        for entry, section_timings in results:
+            entries.append(entry)
+            if timings is not None:
+                for stage, (calls, seconds) in section_timings.items():
+                    _add_timing(timings, stage, seconds, calls)
+    if timings is not None:
+        log.debug("stage timings for building %d sections:\n%s",
+            len(markdown_paths), _format_timings(timings))
+        if _profile is not None:
+            for stage, (calls, seconds) in timings.items():
+                _add_timing(_profile.build_timings, stage, seconds, calls)
+    return entries
+
+def ensure_nodedocs_built(v=DEFAULT_V, jobs=None):
     """Ensure all .nodedoc files are built.
 
+    Out of date sections are built in parallel over a pool of worker
+    processes. Cache files are written atomically, so concurrent builders
+    (e.g. two `nodedoc` processes on a cold cache) don't corrupt them.
+
     @param v {str} Is the node version of the docs to build. This is just
-        the single minor number digit, e.g. "8"."""
-    for markdown_path in glob(join(TOP, "doc", "api"+v, "*.markdown")):
-        ensure_nodedoc_built(markdown_path)
+        the single minor number digit, e.g. "8".
+    @param jobs {int} The number of worker processes to use. If not
+        given, `default_jobs()` is used. Use 1 to build serially.
+    @returns {dict} The cache manifest for the doc tree. Its "sources"
+        are the sections of the tree.
+    """
+    manifest = load_manifest(v)
+    markdown_paths = markdown_paths_from_v(v)
+    to_build = [p for p in markdown_paths
+        if not _check_manifest_entry(manifest, p)]
+    sections = set(splitext(basename(p))[0] for p in markdown_paths)
+    removed = set(manifest["sources"]) - sections
+    if (to_build or removed) and _fall_back_from_prebuilt(v):
+        return ensure_nodedocs_built(v=v, jobs=jobs)
+    entries = build_nodedocs(to_build, jobs)
+
+    for markdown_path, entry in zip(to_build, entries):
+        manifest["sources"][splitext(basename(markdown_path))[0]] = entry
+    for section in removed:
+        del manifest["sources"][section]
+    # The prebuilt cache isn't written to: for sources whose mtime
+    # changed, the digest is just re-checked on each run.
+    dirty = manifest.pop("dirty", False)
+    if (dirty or to_build or removed) and not _using_prebuilt(v):
+        save_manifest(manifest, v)
+    return manifest
 
 def calc_line_start_positions(text):
     line_start_positions = []
@@ -272,113 +745,1035 @@ def calc_line_start_positions(text):
 
 def grep_file(regex, path):
     text = codecs.open(path, 'r', 'utf-8').read()
+    return grep_text(regex, text, path)
+
+def grep_text(regex, text, path=None):
+    """Generate hits of the given header regex in `text`.
+
+    A hit's "start" and "end" are character positions in `text`, and its
+    "offset" is the UTF-8 byte offset of its start, i.e. where it is in
+    the file that `text` was read from.
+    """
+    import bisect
     line_start_positions = None  # lazily built
+    pos = offset = 0
     for match in regex.finditer(text):
         if line_start_positions is None:
             line_start_positions = calc_line_start_positions(text)
         start = match.start()
+        offset += len(text[pos:start].encode('utf-8'))
+        pos = start
         hit = {
             "path": path,
             "header": match.group("h").strip(),
             "start": start,
             "end": match.end(),
+            "offset": offset,
             "line": bisect.bisect_left(line_start_positions, start) + 1
         }
         yield hit
 
-def grep_nodedoc_headers(term, nodedoc_paths=None):
-    """Generate hits of the given term in the headers of the given
-    nodedoc paths. If no paths are given, search all of them.
-    """
-    regex = re.compile(r"""
+def _header_regex(term):
+    return re.compile(r"""
         ^
         (\033\[\d+m)*       # leading ansi escapes
         \#{2,3}             # #'s for h2 or h3
         (?P<h>.*?%s.*?)     # the header text
         (\033\[\d+m)*       # trailing ansi escapes
         $""" % re.escape(term), re.X | re.I | re.M)
+
+def grep_nodedoc_headers(term, nodedoc_paths=None, v=DEFAULT_V):
+    """Generate hits of the given term in the headers of the given
+    nodedoc paths. If no paths are given, search all of them.
+    """
+    regex = _header_regex(term)
     tail = "-%s.nodedoc" % __version__
     if nodedoc_paths is None:
-        nodedoc_paths = glob(join(CACHE_DIR, "*" + tail))
+        nodedoc_paths = glob(join(cache_dir_from_v(v), "*" + tail))
     for nodedoc_path in nodedoc_paths:
-        for hit in grep_file(regex, nodedoc_path):
-            hit["section"] = basename(nodedoc_path[:-len(tail)])
+        section = basename(nodedoc_path[:-len(tail)])
+        start = time.time()
+        hits = list(grep_file(regex, nodedoc_path))
+        if _profile is not None:
+            _profile.add("grep_nodedoc_headers:" + section,
+                time.time() - start)
+        for hit in hits:
+            hit["section"] = section
             yield hit
 
-def nodedoc(section, term=None, opts=None, v=DEFAULT_V):
+# The argument lists in an API header, stripped to get its API name.
+_header_args_re = re.compile(r"\(.*?\)")
+
+def header_index_path(v=DEFAULT_V):
+    return join(cache_dir_from_v(v), "headers-%s.json" % __version__)
+
+def _trigrams(text):
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+def _tokens(text):
+    return set(re.findall(r"\w+", text))
+
+def build_header_index(nodedoc_paths, index_path, v=DEFAULT_V):
+    """Build and save the header index for the given nodedoc paths.
+
+    The index is a list of all h2 and h3 headers (in section and then
+    document order) so that `nodedoc TERM` can be answered without
+    re-reading and regex-scanning every .nodedoc file. A lookup scans
+    that list, except in a daemon, which can keep inverted indexes over
+    it in memory (see `header_postings()`).
+
+    Each header has its section, text, API name (the text without
+    argument lists), line number, and the UTF-8 byte offset of its line
+    in the section's .nodedoc file.
+    """
+    headers = []
+    for hit in grep_nodedoc_headers("", nodedoc_paths):
+        headers.append({
+            "section": hit["section"],
+            "header": hit["header"],
+            "name": _header_args_re.sub("", hit["header"]),
+            "line": hit["line"],
+            "offset": hit["offset"],
+        })
+    headers.sort(key=lambda h: (h["section"], h["offset"]))
+    index = _index_headers(headers, v)
+    _write_file_atomic(index_path, json.dumps(index))
+    return index
+
+def _index_headers(headers, v=DEFAULT_V):
+    return {
+        "version": __version__,
+        "v": v,
+        "headers": headers,
+    }
+
+def load_header_index(index_path):
+    f = open(index_path, 'r')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+# Loaded header indexes: {<index path>: (<tree digest>, <index>)}
+_header_index_cache = {}
+
+def ensure_header_index(v=DEFAULT_V, jobs=None):
+    """Ensure the .nodedoc files and the header index over them are built.
+
+    The index is up to date if it was built from the same sources as
+    are recorded in the cache manifest, so this doesn't need to stat any
+    cache files.
+
+    @param v {str} The node version of the docs, e.g. "8".
+    @param jobs {int} The number of worker processes for building.
+    @returns {dict} The header index.
+    """
+    manifest = ensure_nodedocs_built(v=v, jobs=jobs)
+    tree_digest = _tree_digest(manifest)
+    index_path = header_index_path(v)
+    if manifest.get("index") == tree_digest:
+        # Re-use an already loaded index (e.g. in `nodedoc --serve`).
+        cached = _header_index_cache.get(index_path)
+        if cached and cached[0] == tree_digest:
+            return cached[1]
+        try:
+            index = load_header_index(index_path)
+        except (IOError, ValueError):
+            index = None
+        if index and index.get("version") == __version__:
+            _header_index_cache[index_path] = (tree_digest, index)
+            return index
+    if _fall_back_from_prebuilt(v):
+        return ensure_header_index(v=v, jobs=jobs)
+    log.debug("build header index: %s", index_path)
+    nodedoc_paths = [nodedoc_path_from_section(section, v)
+        for section in manifest["sources"]]
+    index = build_header_index(nodedoc_paths, index_path, v)
+    manifest["index"] = tree_digest
+    save_manifest(manifest, v)
+    _header_index_cache[index_path] = (tree_digest, index)
+    return index
+
+# Whether to search header indexes via inverted indexes (see
+# `header_postings()`). They only pay for themselves in a process that
+# answers many queries, so this is set by `serve()`.
+_use_postings = False
+
+# Inverted indexes built for header indexes:
+# {(<v>, <is source index>): (<index>, <postings>)}
+_header_postings_cache = {}
+
+def header_postings(index):
+    """Return inverted indexes over the headers of the given header index.
+
+    The postings map each lowercased character trigram of a header, and
+    each lowercased word token of its stripped API name, to a list of
+    header ids, so that a lookup only touches the headers that can match.
+    They are built in memory on first use: loading them from a file would
+    cost a one-off `nodedoc TERM` more than the scan they save.
+
+    @returns {dict} {"trigrams": {<trigram>: <ids>},
+        "tokens": {<token>: <ids>}}
+    """
+    headers = index["headers"]
+    key = (index["v"], "sources" in index)
+    cached = _header_postings_cache.get(key)
+    if cached and cached[0] is index:
+        return cached[1]
+    trigrams = {}
+    tokens = {}
+    for i, header in enumerate(headers):
+        for trigram in _trigrams(header["header"].lower()):
+            trigrams.setdefault(trigram, []).append(i)
+        for token in _tokens(header["name"].lower()):
+            tokens.setdefault(token, []).append(i)
+    postings = {"trigrams": trigrams, "tokens": tokens}
+    _header_postings_cache[key] = (index, postings)
+    return postings
+
+def _intersect_postings(postings):
+    """Return the sorted intersection of the given posting lists."""
+    if not postings:
+        return []
+    postings = sorted(postings, key=len)
+    ids = set(postings[0])
+    for posting in postings[1:]:
+        if not ids:
+            break
+        ids.intersection_update(posting)
+    return sorted(ids)
+
+def search_header_index(index, term, postings=None):
+    """Generate hits of the given term (case-insensitive substring) in
+    the headers of the given header index.
+
+    If the index's `postings` are given (see `header_postings()`) then
+    candidate headers are those in every trigram posting list for the
+    term. Otherwise, or for terms shorter than a trigram, all the headers
+    are scanned.
+    """
+    term = term.lower()
+    headers = index["headers"]
+    if postings is None or len(term) < 3:
+        ids = xrange(len(headers))
+    else:
+        trigrams = postings["trigrams"]
+        postings = []
+        for trigram in _trigrams(term):
+            if trigram not in trigrams:
+                return
+            postings.append(trigrams[trigram])
+        ids = _intersect_postings(postings)
+    for i in ids:
+        header = headers[i]
+        if term in header["header"].lower():
+            hit = dict(header)
+            hit["id"] = i
+            hit["path"] = nodedoc_path_from_section(hit["section"],
+                index["v"])
+            yield hit
+
+def exact_hits(hits, term, postings=None):
+    """Return the subset of `hits` that are "exact" matches for `term`.
+
+    Re "exact": Take this example:
+          ## fs.chown(path, uid, gid, [callback])
+    Here "fs.chown" or "chown" would be exact matches. Harder
+    example:
+          ## assert(value, message), assert.ok(value, [message])
+    Here "ok" is an exact match. Note that "value" and "message"
+    are not exact matches: we care about function names, not args.
+
+    If the term is a single word and the `postings` of the index that the
+    hits came from are given, the name token posting list is used to skip
+    non-candidates.
+    """
+    candidate_ids = None
+    if postings is not None and re.match(r"^\w+$", term):
+        candidate_ids = set(postings["tokens"].get(term.lower(), []))
+    exact = []
+    for hit in hits:
+        if candidate_ids is not None and hit.get("id") not in candidate_ids:
+            continue
+        stripped = hit.get("name")
+        if stripped is None:
+            stripped = _header_args_re.sub("", hit["header"])
+        if re.search(r'\b%s\b' % re.escape(term), stripped):
+            exact.append(hit)
+            hit["exact"] = True
+    return exact
+
+
+#---- source header index (lazy builds)
+
+# h2-h4 headers, as for markdown2's atx headers. (The header grep of a
+# .nodedoc file matches "#### foo" as "# foo".)
+_source_header_re = re.compile(r"^(\#{2,4})[ \t]*(.+?)[ \t]*(?<!\\)\#*$")
+_link_def_re = re.compile(r"^[ ]{0,3}\[.+\]:[ \t]*\S")
+_inline_markup_re = re.compile(r"[`*_\\<&\[]")
+
+def use_lazy():
+    """Whether to resolve `nodedoc TERM` from the markdown sources, set by
+    $NODEDOC_LAZY.
+    """
+    return bool(os.environ.get("NODEDOC_LAZY"))
+
+def source_index_path(v=DEFAULT_V):
+    return join(cache_dir_from_v(v), "source-headers-%s.json" % __version__)
+
+def _source_headers(markdown_path):
+    """Return the h2-h4 headers of the given markdown source as they would
+    be found in its rendered .nodedoc file.
+
+    The headers are found with a line scan. Only those with inline markup
+    (e.g. `code` or escapes) are rendered, together in one small document
+    with the source's link definitions.
+
+    @returns {tuple} (<list of header texts>, <cache manifest entry>)
+    """
+    st = os.stat(markdown_path)
+    f = open(markdown_path, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    headers = []
+    marked_up = []  # (<index in `headers`>, <markdown>) to render
+    link_defs = []
+    for line in data.decode('utf-8').splitlines():
+        match = _source_header_re.match(line)
+        if match:
+            hashes, text = match.groups()
+            if _inline_markup_re.search(text):
+                marked_up.append((len(headers), hashes + " " + text))
+            headers.append((hashes[3:] + " " + text).strip())
+        elif _link_def_re.match(line):
+            link_defs.append(line)
+    if marked_up:
+        import markdown2
+        html = markdown2.markdown(
+            "\n\n".join([h for i, h in marked_up] + link_defs))
+        rendered = [hit["header"] for hit in
+            grep_text(_header_regex(""), render_nodedoc(html))]
+        if len(rendered) == len(marked_up):
+            for (i, h), header in zip(marked_up, rendered):
+                headers[i] = header
+    return headers, {"size": len(data), "mtime": st.st_mtime,
+        "digest": _digest(data)}
+
+def build_source_index(v=DEFAULT_V):
+    """Build and save the source header index for the given doc tree.
+
+    This is a header index (see `build_header_index`) built from the
+    markdown sources without rendering them. Headers have an "ordinal"
+    (the header's number in its section) instead of a line number. The
+    index's "sources" are as for the cache manifest.
+    """
+    headers = []
+    sources = {}
+    for markdown_path in markdown_paths_from_v(v):
+        section = splitext(basename(markdown_path))[0]
+        texts, sources[section] = _source_headers(markdown_path)
+        for ordinal, text in enumerate(texts):
+            headers.append({
+                "section": section,
+                "header": text,
+                "name": _header_args_re.sub("", text),
+                "ordinal": ordinal,
+            })
+    headers.sort(key=lambda h: (h["section"], h["ordinal"]))
+    index = _index_headers(headers, v)
+    index["sources"] = sources
+    _write_file_atomic(source_index_path(v), json.dumps(index))
+    return index
+
+# Loaded source header indexes: {<index path>: <index>}
+_source_index_cache = {}
+
+def ensure_source_index(v=DEFAULT_V):
+    """Ensure the source header index for the given doc tree is up to
+    date. No sections are rendered for this.
+
+    @param v {str} The node version of the docs, e.g. "8".
+    @returns {dict} The source header index.
+    """
+    index_path = source_index_path(v)
+    index = _source_index_cache.get(index_path)
+    if index is None:
+        try:
+            index = load_header_index(index_path)
+        except (IOError, ValueError):
+            index = None
+    if index is not None and index.get("version") == __version__:
+        markdown_paths = markdown_paths_from_v(v)
+        sections = set(splitext(basename(p))[0] for p in markdown_paths)
+        if (sections == set(index["sources"])
+            and all(_check_manifest_entry(index, p) for p in markdown_paths)):
+            if index.pop("dirty", False):
+                _write_file_atomic(index_path, json.dumps(index))
+            _source_index_cache[index_path] = index
+            return index
+    log.debug("build source header index: %s", index_path)
+    index = _source_index_cache[index_path] = build_source_index(v)
+    return index
+
+def _page_source_hit(hit, v=DEFAULT_V):
+    """Return the page action for a hit from the source header index.
+
+    Only the hit's section is rendered. Its line is that of the header
+    with the same ordinal in the rendered section.
+    """
+    nodedoc_path = ensure_nodedoc_built(
+        markdown_path_from_section(hit["section"], v))
+    line = None
+    for ordinal, h in enumerate(grep_nodedoc_headers("", [nodedoc_path])):
+        if ordinal == hit["ordinal"]:
+            line = h["line"]
+            break
+    return {"action": "page", "path": nodedoc_path, "line": line}
+
+
+#---- packed cache
+
+PACK_MAGIC = "NODEDOCPACK1\n"
+
+def use_pack():
+    """Whether to use the packed cache file, set by $NODEDOC_PACK."""
+    return bool(os.environ.get("NODEDOC_PACK"))
+
+def pack_path(v=DEFAULT_V):
+    """The packed cache file for the given doc tree.
+
+    The prebuilt cache doesn't ship one (it holds the same content as the
+    prebuilt sections), so for that the pack is built from the prebuilt
+    sections into the user cache dir on first use.
+    """
+    cache_dir = cache_dir_from_v(v)
+    if _using_prebuilt(v):
+        cache_dir = join(CACHE_DIR, basename(cache_dir))
+    return join(cache_dir, "nodedoc-%s.pack" % __version__)
+
+def write_pack(manifest, index, v=DEFAULT_V):
+    """Write the packed cache file for the given doc tree.
+
+    The pack holds all of the tree's rendered sections and its header
+    index in one file, so a warm `nodedoc` run opens a single file:
+
+        NODEDOCPACK1
+        {"version": ..., "sources": <manifest sources>,
+         "sections": {<section>: [<offset>, <length>], ...},
+         "index": [<offset>, <length>]}
+        <rendered sections...><header index JSON>
+
+    Offsets are relative to the end of the JSON header line. The
+    manifest's source entries are carried along so that the pack can be
+    validated without reading the cache manifest.
+    """
+    blobs = []
+    sections = {}
+    offset = 0
+    for section in sorted(manifest["sources"]):
+        f = open(nodedoc_path_from_section(section, v), 'rb')
+        try:
+            blob = f.read()
+        finally:
+            f.close()
+        sections[section] = [offset, len(blob)]
+        blobs.append(blob)
+        offset += len(blob)
+    index_blob = json.dumps(index)
+    blobs.append(index_blob)
+    header = {
+        "version": __version__,
+        "sources": manifest["sources"],
+        "sections": sections,
+        "index": [offset, len(index_blob)],
+    }
+    _write_file_atomic(pack_path(v),
+        PACK_MAGIC + json.dumps(header) + "\n" + "".join(blobs))
+
+class NodedocPack(object):
+    """A read-only view of a packed cache file (see `write_pack`).
+
+    The file is mmap'd, so sections are sliced out of the page cache
+    rather than read.
+    """
+    def __init__(self, path):
+        import mmap
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if self.mmap[:len(PACK_MAGIC)] != PACK_MAGIC:
+            raise ValueError("not a nodedoc pack: '%s'" % path)
+        end = self.mmap.find("\n", len(PACK_MAGIC))
+        if end == -1:
+            raise ValueError("truncated nodedoc pack: '%s'" % path)
+        self.header = json.loads(self.mmap[len(PACK_MAGIC):end])
+        self.base = end + 1
+        self._index = None
+
+    def span(self, section):
+        """Return the (offset, length) of the given rendered section in
+        the pack file.
+        """
+        offset, length = self.header["sections"][section]
+        return self.base + offset, length
+
+    def text(self, section):
+        offset, length = self.span(section)
+        return self.mmap[offset:offset+length].decode('utf-8')
+
+    @property
+    def index(self):
+        if self._index is None:
+            offset, length = self.header["index"]
+            offset += self.base
+            self._index = json.loads(self.mmap[offset:offset+length])
+        return self._index
+
+# Opened packs: {<pack path>: <NodedocPack>}
+_pack_cache = {}
+
+def ensure_pack(v=DEFAULT_V, jobs=None):
+    """Ensure the packed cache file for the given doc tree is up to date.
+
+    The pack is checked against the markdown sources as for the cache
+    manifest (see `load_manifest`). If it is stale, the .nodedoc files
+    and header index are brought up to date and the pack rewritten.
+
+    @param v {str} The node version of the docs, e.g. "8".
+    @param jobs {int} The number of worker processes for building.
+    @returns {NodedocPack} The opened pack.
+    """
+    path = pack_path(v)
+    pack = _pack_cache.get(path)
+    if pack is None:
+        try:
+            pack = NodedocPack(path)
+        except (EnvironmentError, ValueError):
+            pack = None
+    if pack is not None and pack.header.get("version") == __version__:
+        markdown_paths = markdown_paths_from_v(v)
+        sections = set(splitext(basename(p))[0] for p in markdown_paths)
+        if (sections == set(pack.header["sources"])
+            and all(_check_manifest_entry(pack.header, p)
+                    for p in markdown_paths)
+            and (not pack.header.get("dirty") or _using_prebuilt(v))):
+            _pack_cache[path] = pack
+            return pack
+    index = ensure_header_index(v=v, jobs=jobs)
+    path = pack_path(v)  # may have switched from the prebuilt cache
+    log.debug("build pack: %s", path)
+    write_pack(load_manifest(v), index, v)
+    pack = _pack_cache[path] = NodedocPack(path)
+    return pack
+
+def grep_pack_headers(term, pack, sections):
+    """Generate hits of the given term in the headers of the given
+    sections of a pack.
+    """
+    regex = _header_regex(term)
+    for section in sections:
+        for hit in grep_text(regex, pack.text(section), pack.path):
+            hit["section"] = section
+            yield hit
+
+def _page_section(section, line=None, pack=None):
+    """Return the page action for a section in the given pack."""
+    offset, length = pack.span(section)
+    return {"action": "page", "path": pack.path, "offset": offset,
+        "length": length, "line": line}
+
+
+#---- query resolution
+
+def _decode_term(term):
+    """Decode a query term from the command line (bytes on Python 2), so
+    that it can be compared with the headers.
+    """
+    if isinstance(term, str):
+        term = term.decode("utf-8", "replace")
+    return term
+
+def _page_hit(hit, v=DEFAULT_V, pack=None):
+    """Return the page action for the given header hit, rebuilding its
+    .nodedoc file if it has gone missing from the cache.
+    """
+    if pack is not None:
+        return _page_section(hit["section"], hit["line"], pack)
+    elif "ordinal" in hit:
+        return _page_source_hit(hit, v)
+    if not exists(hit["path"]):
+        ensure_nodedoc_built(markdown_path_from_section(hit["section"], v))
+    return {"action": "page", "path": hit["path"], "line": hit["line"]}
+
+def resolve(section, term=None, want_list=False, v=DEFAULT_V, jobs=None):
+    """Resolve a `nodedoc SECTION`, `nodedoc TERM` or `nodedoc SECTION TERM`
+    query to what should be shown.
+
+    @returns {dict} One of:
+        {"action": "page", "path": <nodedoc path>, "line": <line or None>}
+        {"action": "list", "hits": <list of hits>}
+        If using the packed cache, page actions are for the pack file and
+        also have the "offset" and "length" of the section within it.
+    """
+    pack = None
+    if use_pack():
+        pack = ensure_pack(v=v, jobs=jobs)
+
     if term is None:
         # `nodedoc SECTION`
-        markdown_path = join(TOP, "doc", "api"+v, section + ".markdown")
-        if exists(markdown_path):
-            return nodedoc_section(section, v=v)
+        markdown_path = markdown_path_from_section(section, v)
+        if exists(markdown_path) and pack is not None:
+            return _page_section(section, None, pack)
+        elif exists(markdown_path):
+            nodedoc_path = ensure_nodedoc_built(markdown_path)
+            return {"action": "page", "path": nodedoc_path, "line": None}
 
     if term is not None:
         # `nodedoc SECTION TERM`
-        markdown_path = join(TOP, "doc", "api"+v, section + ".markdown")
+        markdown_path = markdown_path_from_section(section, v)
         if not exists(markdown_path):
             raise Error("no such section: '%s'" % section)
-        nodedoc_path = ensure_nodedoc_built(markdown_path)
-        hits = list(grep_nodedoc_headers(term, [nodedoc_path]))
+        term = _decode_term(term)
+        if pack is not None:
+            hits = list(grep_pack_headers(term, pack, [section]))
+        else:
+            nodedoc_path = ensure_nodedoc_built(markdown_path)
+            hits = list(grep_nodedoc_headers(term, [nodedoc_path]))
+        postings = None
     else:
         # `nodedoc TERM`
-        term = section
-        ensure_nodedocs_built(v=v)
-        hits = list(grep_nodedoc_headers(term))
+        term = _decode_term(section)
+        if pack is not None:
+            index = pack.index
+        elif use_lazy() and not _using_prebuilt(v):
+            index = ensure_source_index(v)
+        else:
+            index = ensure_header_index(v=v, jobs=jobs)
+        postings = None
+        if _use_postings:
+            postings = header_postings(index)
+        hits = list(search_header_index(index, term, postings))
 
     if len(hits) == 0:
         raise Error("no such section or API method match: '%s'" % section)
-    elif len(hits) == 1 and not opts.list:
-        return page_nodedoc(hits[0]["path"], hits[0]["line"])
+    elif len(hits) == 1 and not want_list:
+        return _page_hit(hits[0], v, pack)
     else:
-        exact_hits = []
-        if not opts.list:
+        exact = []
+        if not want_list:
             # See if this is an "exact" match. If so, and is the only such
             # match, then page it instead of a list of all matches.
-            # Re "exact": Take this example:
-            #       ## fs.chown(path, uid, gid, [callback])
-            # Here "fs.chown" or "chown" would be exact matches. Harder
-            # example:
-            #       ## assert(value, message), assert.ok(value, [message])
-            # Here "ok" is an exact match. Note that "value" and "message"
-            # are not exact matches: we care about function names, not args.
-            arg_stripper = re.compile("\(.*?\)")
-            for hit in hits:
-                stripped = arg_stripper.sub("", hit["header"])
-                if re.search(r'\b%s\b' % re.escape(term), stripped):
-                    exact_hits.append(hit)
-                    hit["exact"] = True
-            #pprint(exact_hits)
-
-        if len(exact_hits) == 1:
-            return page_nodedoc(exact_hits[0]["path"], exact_hits[0]["line"])
+            exact = exact_hits(hits, term, postings)
+
+        if len(exact) == 1:
+            return _page_hit(exact[0], v, pack)
         else:
-            print "SECTION          API"
-            for hit in hits:
-                print "%(section)-15s  %(header)s" % hit
+            return {"action": "list", "hits": hits}
+
+def nodedoc(section, term=None, opts=None, v=DEFAULT_V):
+    result = None
+    if not opts.no_daemon:
+        result = query_daemon(section, term, want_list=opts.list, v=v)
+    if result is None:
+        result = resolve(section, term, want_list=opts.list, v=v,
+            jobs=opts.jobs)
+
+    if result["action"] == "page":
+        return page_nodedoc(result["path"], result["line"],
+            result.get("offset"), result.get("length"))
+    else:
+        print "SECTION          API"
+        for hit in result["hits"]:
+            print "%(section)-15s  %(header)s" % hit
 
-def page_nodedoc(path, line=None):
+def page_nodedoc(path, line=None, offset=None, length=None):
+    """Page the given nodedoc file, or the `length` bytes at `offset` in
+    it (a section in a pack file), optionally starting at `line`.
+    """
     # TODO: Windows
     pager = os.environ.get("PAGER", "less -R")
+    if offset is not None:
+        return _page_slice(path, offset, length, pager, line)
     if line:
         cmd = 'cat "%s" 2>/dev/null | %s "+%dG"' % (path, pager, line)
     else:
         cmd = 'cat "%s" 2>/dev/null | %s' % (path, pager)
+    if _profile is not None:
+        _profile.mark_pager()
     return os.system(cmd)
 
-def nodedoc_section(section, v=DEFAULT_V):
-    markdown_path = join(TOP, "doc", "api"+v, section + ".markdown")
-    if not exists(markdown_path):
-        raise Error("no such section: '%s'" % section)
-    nodedoc_path = ensure_nodedoc_built(markdown_path)
-    return page_nodedoc(nodedoc_path)
+def _page_slice(path, offset, length, pager, line=None):
+    import errno
+    import mmap
+    import subprocess
+    if line:
+        cmd = '%s "+%dG"' % (pager, line)
+    else:
+        cmd = pager
+    f = open(path, 'rb')
+    try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    if _profile is not None:
+        _profile.mark_pager()
+    p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+    try:
+        p.stdin.write(buffer(m, offset, length))
+        p.stdin.close()
+    except IOError, ex:
+        if ex.errno != errno.EPIPE:  # the pager was quit early
+            raise
+    return p.wait()
 
 def nodedoc_sections(v=DEFAULT_V):
-    markdown_paths = glob(join(TOP, "doc", "api"+v, "*.markdown"))
+    markdown_paths = markdown_paths_from_v(v)
     for p in markdown_paths:
         first_line = codecs.open(p, 'r', 'utf-8').read(1024).split('\n', 1)[0]
         desc = first_line.lstrip(' #')
         yield {"name": splitext(basename(p))[0], "desc": desc}
 
+def prebuild(jobs=None):
+    """Build the rendered docs of each doc tree into "prebuilt/" for
+    shipping with the package (see `make prebuild`).
+
+    A fresh install then uses these as is, so it needn't run markdown2,
+    nor write to the user cache dir, until a doc source changes.
+    """
+    import shutil
+    # Build in a staging dir: the prebuilt cache itself is read-only.
+    staging_dir = PREBUILT_DIR + ".tmp"
+    if exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    names = {}
+    markdown_paths = []
+    for ver in DOC_VERSIONS:
+        v = str(ver[1])
+        names[v] = "v" + ".".join(map(str, ver))
+        _cache_dirs[v] = join(staging_dir, names[v])
+        markdown_paths += markdown_paths_from_v(v)
+
+    # Build the sections of all the trees in one go.
+    log.info("prebuild %d doc sections", len(markdown_paths))
+    manifests = {}
+    for markdown_path, entry in zip(markdown_paths,
+            build_nodedocs(markdown_paths, jobs)):
+        v = _v_from_markdown_path(markdown_path)
+        if v not in manifests:
+            manifests[v] = load_manifest(v)
+        section = splitext(basename(markdown_path))[0]
+        manifests[v]["sources"][section] = entry
+
+    for v, manifest in sorted(manifests.items()):
+        log.info("prebuild docs: %s", join(PREBUILT_DIR, names[v]))
+        save_manifest(manifest, v)
+        ensure_header_index(v=v, jobs=jobs)
+    if exists(PREBUILT_DIR):
+        shutil.rmtree(PREBUILT_DIR)
+    os.rename(staging_dir, PREBUILT_DIR)
+
+
+
+#---- daemon mode
+
+def socket_path():
+    return os.environ.get("NODEDOC_SOCKET") or join(CACHE_DIR, "nodedoc.sock")
+
+def query_daemon(section, term=None, want_list=False, v=DEFAULT_V):
+    """Ask a running `nodedoc --serve` daemon to resolve the query.
+
+    @returns {dict} The resolved result (see `resolve()`), or None if no
+        daemon is available, in which case the caller should resolve
+        in-process.
+    """
+    path = socket_path()
+    if not exists(path):
+        return None
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5.0)
+    try:
+        try:
+            sock.connect(path)
+            request = {"version": __version__, "section": section,
+                "term": term, "list": want_list, "v": v}
+            sock.sendall(json.dumps(request) + "\n")
+            f = sock.makefile('r')
+            response = json.loads(f.readline())
+            f.close()
+        except (socket.error, ValueError), ex:
+            log.debug("nodedoc daemon at '%s' not available: %s", path, ex)
+            return None
+    finally:
+        sock.close()
+    if "error" in response:
+        if response.get("version") != __version__:
+            log.debug("nodedoc daemon version mismatch: %s", response["error"])
+            return None
+        raise Error(response["error"].encode("utf-8"))
+    return response
+
+def _error_message(ex):
+    """The message of the given exception as unicode, for a JSON reply."""
+    try:
+        return unicode(ex)
+    except UnicodeError:
+        return str(ex).decode("utf-8", "replace")
+
+def _parse_request(line):
+    """Parse a `nodedoc --serve` request line, raising `Error` if it isn't
+    a valid request.
+    """
+    try:
+        request = json.loads(line)
+    except ValueError, ex:
+        raise Error("invalid request: %s" % ex)
+    if not isinstance(request, dict):
+        raise Error("invalid request: not a JSON object")
+    if request.get("version") != __version__:
+        raise Error("client version %s does not match daemon version %s"
+            % (request.get("version"), __version__))
+    if not isinstance(request.get("section"), unicode):
+        raise Error("invalid request: no \"section\" string")
+    if not isinstance(request.get("term"), (unicode, type(None))):
+        raise Error("invalid request: \"term\" is not a string")
+    if not isinstance(request.get("v", u""), unicode):
+        raise Error("invalid request: \"v\" is not a string")
+    return request
+
+def serve(path=None):
+    """Serve `nodedoc` queries on a Unix domain socket until interrupted.
+
+    The daemon keeps the loaded header indexes in memory, so clients only
+    pay for a socket round trip. It also keeps inverted indexes over them
+    (see `header_postings()`).
+
+    Each request and response is a single line of JSON. A request is
+    `{"version": ..., "section": ..., "term": ..., "list": ..., "v": ...}`.
+    The response is the `resolve()` result or `{"error": <message>,
+    "version": ...}`.
+    """
+    global _use_postings
+    import signal
+    import socket
+    import SocketServer
+    import threading
+
+    # Each connection is handled in its own thread, so a slow or idle
+    # client only holds up itself. Queries are answered one at a time:
+    # they are quick once the indexes are loaded, and a query on a stale
+    # doc tree rebuilds its cache files.
+    resolve_lock = threading.Lock()
+
+    class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    class _Handler(SocketServer.StreamRequestHandler):
+        # Drop a client that doesn't send its request promptly.
+        timeout = 1.0
+
+        def handle(self):
+            try:
+                line = self.rfile.readline()
+            except socket.error, ex:
+                log.debug("dropped client connection: %s", ex)
+                return
+            if not line.endswith("\n"):
+                log.debug("dropped client connection: incomplete request")
+                return
+            try:
+                request = _parse_request(line)
+                # Resolve the section and term as given on the client's
+                # command line.
+                term = request.get("term")
+                if term is not None:
+                    term = term.encode("utf-8")
+                resolve_lock.acquire()
+                try:
+                    response = resolve(request["section"].encode("utf-8"),
+                        term, want_list=request.get("list"),
+                        v=request.get("v", DEFAULT_V).encode("utf-8"))
+                finally:
+                    resolve_lock.release()
+            except Exception, ex:
+                if not isinstance(ex, Error):
+                    log.exception("error handling request")
+                response = {"error": _error_message(ex),
+                    "version": __version__}
+            if response.get("action") == "list":
+                response["hits"] = [{"section": h["section"],
+                    "header": h["header"]} for h in response["hits"]]
+            try:
+                self.wfile.write(json.dumps(response) + "\n")
+            except socket.error, ex:
+                log.debug("dropped client connection: %s", ex)
+
+    if path is None:
+        path = socket_path()
+    if exists(path):
+        # Only take over the socket if no other daemon is listening on it.
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(path)
+            except socket.error:
+                os.remove(path)
+            else:
+                raise Error("a nodedoc daemon is already serving on '%s'"
+                    % path)
+        finally:
+            sock.close()
+    elif not exists(dirname(path)):
+        os.makedirs(dirname(path))
+
+    # Warm up with the indexes for all doc versions.
+    _use_postings = True
+    for ver in DOC_VERSIONS:
+        header_postings(ensure_header_index(v=str(ver[1])))
+
+    server = _Server(path, _Handler)
+    # Exit via SystemExit on SIGTERM so the socket file is cleaned up.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info("serving on '%s'", path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if exists(path):
+            os.remove(path)
+
+
+
+#---- profiling
+
+# The functions timed as stages of a command by `--profile`.
+_PROFILED_FUNCTIONS = ["query_daemon", "resolve", "load_manifest",
+    "save_manifest", "_check_manifest_entry", "ensure_nodedoc_built",
+    "ensure_nodedocs_built", "build_nodedocs", "generate_nodedoc_path",
+    "ensure_header_index", "load_header_index", "build_header_index",
+    "header_postings", "search_header_index", "exact_hits",
+    "grep_nodedoc_headers",
+    "ensure_source_index", "build_source_index", "ensure_pack",
+    "write_pack", "grep_pack_headers", "page_nodedoc", "prebuild"]
+
+# The `_Profile` of this command, if profiling (see `_start_profile()`).
+_profile = None
+
+class _Profile(object):
+    """Where the time of a nodedoc command went.
+
+    `timings` maps each stage to its number of calls and the seconds
+    spent in it, not counting the stages it calls, so that the stages add
+    up to the total. `build_timings` are the stages of building sections
+    (see `build_nodedocs()`), summed over the build workers.
+    """
+    def __init__(self, start):
+        self.start = start
+        self.timings = {}
+        self.build_timings = {}
+        self.pager = None   # seconds until the pager was spawned
+        self._stack = []    # the time of the stages called by each stage
+
+    def add(self, stage, seconds):
+        if self._stack:
+            self._stack[-1] += seconds
+        _add_timing(self.timings, stage, seconds)
+
+    def wrap(self, stage, func):
+        """Wrap `func` to time its calls as `stage`. The results of
+        generator functions are gathered into a list, to time them.
+        """
+        import types
+        def timed(*args, **kwargs):
+            self._stack.append(0.0)
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+                return result
+            finally:
+                elapsed = time.time() - start
+                inner = self._stack.pop()
+                if self._stack:
+                    self._stack[-1] += elapsed
+                _add_timing(self.timings, stage, elapsed - inner)
+        return timed
+
+    def mark_pager(self):
+        self.pager = time.time() - self.start
+
+    def report(self, argv, format="text"):
+        total = time.time() - self.start
+        if format == "json":
+            return json.dumps({
+                "command": argv[1:],
+                "version": __version__,
+                "host": os.uname()[1],
+                "python": sys.version.split()[0],
+                "cache_dir": CACHE_DIR,
+                "total": total,
+                "pager": self.pager,
+                "stages": _json_timings(self.timings),
+                "build_stages": _json_timings(self.build_timings),
+            }, sort_keys=True)
+        lines = ["nodedoc profile: `%s`" % " ".join(["nodedoc"] + argv[1:])]
+        summary = "total %.1fms" % (total * 1000.0)
+        if self.pager is not None:
+            summary += ", pager spawned at %.1fms" % (self.pager * 1000.0)
+        lines.append(summary)
+        lines.append(_format_timings(self.timings, total))
+        if self.build_timings:
+            lines.append("stages of building sections (over all workers):")
+            lines.append(_format_timings(self.build_timings))
+        return "\n".join(lines)
+
+def _start_profile():
+    """Start profiling this command: time the `_PROFILED_FUNCTIONS`."""
+    global _profile
+    _profile = _Profile(_start_time)
+    main_start = time.time()
+    _profile.add("_get_doc_versions", _doc_versions_time)
+    _profile.add("import", main_start - _start_time - _doc_versions_time)
+    g = globals()
+    for name in _PROFILED_FUNCTIONS:
+        g[name] = _profile.wrap(name, g[name])
+
+def _add_timing(timings, stage, seconds, calls=1):
+    counts = timings.get(stage)
+    if counts is None:
+        counts = timings[stage] = [0, 0.0]
+    counts[0] += calls
+    counts[1] += seconds
+
+def _json_timings(timings):
+    return dict((stage, {"calls": calls, "seconds": seconds})
+        for stage, (calls, seconds) in timings.items())
+
+def _format_timings(timings, total=None):
+    """Format stage timings as a table, slowest stage first. If `total`
+    is given, the time not in any stage is shown as "(other)".
+    """
+    timed = sum(seconds for calls, seconds in timings.values())
+    if total is None:
+        total = timed
+    items = sorted(((seconds, stage, calls)
+        for stage, (calls, seconds) in timings.items()), reverse=True)
+    width = max([len(stage) for stage in timings] + [len("(other)")])
+    lines = ["    %-*s %7s %10s %6s" % (width, "STAGE", "CALLS", "TIME", "%")]
+    for seconds, stage, calls in items:
+        lines.append("    %-*s %7d %8.1fms %5.1f%%" % (width, stage, calls,
+            seconds * 1000.0, total and seconds * 100.0 / total))
+    if total > timed:
+        lines.append("    %-*s %7s %8.1fms %5.1f%%" % (width, "(other)", "",
+            (total - timed) * 1000.0, (total - timed) * 100.0 / total))
+    return "\n".join(lines)
+
 
 
 #---- other internal support stuff
@@ -395,23 +1790,50 @@ def _setup_logging():
     hdlr.setFormatter(fmtr)
     logging.root.addHandler(hdlr)
 
-class _NoReflowFormatter(optparse.IndentedHelpFormatter):
-    """An optparse formatter that does NOT reflow the description."""
-    def format_description(self, description):
-        return description or ""
+def _write_file_atomic(path, content):
+    """Write the given bytes to `path` atomically.
 
-def mtime(path):
-    return os.stat(path).st_mtime
+    The content is written to a temporary file in the same dir and then
+    renamed into place, so readers (and concurrent writers) never see a
+    partially written file.
+    """
+    import tempfile
+    d = dirname(path)
+    if not exists(d):
+        try:
+            os.makedirs(d)
+        except OSError:
+            if not exists(d):
+                raise
+    fd, tmp_path = tempfile.mkstemp(dir=d, prefix="." + basename(path) + ".")
+    try:
+        # mkstemp creates the file 0600; use the usual umask-based mode.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0666 & ~umask)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    except:
+        if exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
 
 #---- mainline
 
-def main(argv=sys.argv):
-    _setup_logging()
-    log.setLevel(logging.INFO)
+def _option_parser():
+    import optparse
+
+    class _NoReflowFormatter(optparse.IndentedHelpFormatter):
+        """An optparse formatter that does NOT reflow the description."""
+        def format_description(self, description):
+            return description or ""
 
-    # Parse options.
     parser = optparse.OptionParser(prog="nodedoc", usage='',
         version="%prog " + __version__, description=__doc__,
         formatter=_NoReflowFormatter())
@@ -423,6 +1845,23 @@ def main(argv=sys.argv):
         help="quieter output (just warnings and errors)")
     parser.add_option("-l", "--list", action="store_true",
         help="list all nodedoc sections or API hits (if args given)")
+    parser.add_option("-j", "--jobs", type="int",
+        help="number of worker processes for building the doc cache "
+            "(default is $NODEDOC_JOBS or the number of CPUs)")
+    parser.add_option("--serve", action="store_true",
+        help="run a daemon answering nodedoc queries on a local socket "
+            "(%s)" % socket_path())
+    parser.add_option("--no-daemon", action="store_true",
+        help="don't use a running `nodedoc --serve` daemon")
+    parser.add_option("--profile", action="store_const", const="text",
+        help="print where the command's time went to stderr "
+            "(or set NODEDOC_PROFILE=1)")
+    parser.add_option("--profile-json", dest="profile",
+        action="store_const", const="json",
+        help="print that profile as JSON (or set NODEDOC_PROFILE=json)")
+    parser.add_option("--prebuild", action="store_true",
+        help="build the docs into '%s' for shipping with the package"
+            % PREBUILT_DIR)
     v8 = ".".join(map(str, DOC_VERSIONS[0]))
     v10 = ".".join(map(str, DOC_VERSIONS[1]))
     vD = ".".join(map(str, DOC_VERSIONS[-1]))
@@ -431,23 +1870,62 @@ def main(argv=sys.argv):
     parser.add_option("-1", action="store_const", dest="v", const="10",
         help="use %s docs (default is %s)" % (v10, vD))
     parser.set_defaults(log_level=logging.INFO, v=DEFAULT_V)
-    opts, args = parser.parse_args()
+    return parser
+
+class _DefaultOptions(object):
+    """The option values for a command line without any options."""
+    log_level = logging.INFO
+    v = DEFAULT_V
+    list = jobs = serve = no_daemon = prebuild = profile = None
+
+def main(argv=sys.argv):
+    _setup_logging()
+    log.setLevel(logging.INFO)
+
+    # Parse options. The common `nodedoc SECTION`, `nodedoc TERM` and
+    # `nodedoc SECTION TERM` commands don't have any, so for those optparse
+    # (and the gettext and textwrap modules it imports) isn't loaded.
+    args = argv[1:]
+    if len(args) in (1, 2) and not [a for a in args if a.startswith("-")]:
+        opts = _DefaultOptions()
+    else:
+        parser = _option_parser()
+        opts, args = parser.parse_args(args)
     log.setLevel(opts.log_level)
 
-    if not args and opts.list:
+    profile = opts.profile or os.environ.get("NODEDOC_PROFILE")
+    if not profile:
+        return _run_command(opts, args)
+    if profile != "json":
+        profile = "text"
+    _start_profile()
+    try:
+        return _run_command(opts, args)
+    finally:
+        sys.stderr.write(_profile.report(argv, profile) + "\n")
+
+def _run_command(opts, args):
+    if opts.serve:
+        return serve()
+    elif opts.prebuild:
+        return prebuild(jobs=opts.jobs)
+    elif not args and opts.list:
         print "SECTION          DESCRIPTION"
         for section in nodedoc_sections(v=opts.v):
             print "%(name)-15s  %(desc)s" % section
     elif len(args) not in (1, 2):
-        parser.print_help()
+        _option_parser().print_help()
     else:
         return nodedoc(*args, opts=opts, v=opts.v)
 
 
 ## {{{ http://code.activestate.com/recipes/577258/ (r4)
-if __name__ == "__main__":
+def run(argv=sys.argv):
+    """Run `main` and exit, reporting errors as the `nodedoc` command
+    does. This is the entry point for "bin/nodedoc".
+    """
     try:
-        retval = main(sys.argv)
+        retval = main(argv)
     except KeyboardInterrupt:
         sys.exit(1)
     except SystemExit:
@@ -479,3 +1957,6 @@ if __name__ == "__main__":
     else:
         sys.exit(retval)
 ## end of http://code.activestate.com/recipes/577258/ }}}
+
+if __name__ == "__main__":
+    run()
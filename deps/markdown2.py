@@ -86,15 +86,10 @@ __author__ = "Trent Mick"
 
 import os
 import sys
-from pprint import pprint
 import re
 import logging
-try:
-    from hashlib import md5
-except ImportError:
-    from md5 import md5
-import optparse
-from random import random, randint
+from random import random
+from bisect import bisect_left
 import codecs
 
 
@@ -133,14 +128,51 @@ log = logging.getLogger("markdown")
 
 DEFAULT_TAB_WIDTH = 4
 
+class _lazy_re(object):
+    """A regex that is only compiled when it is first used.
 
-SECRET_SALT = bytes(randint(0, 1000000))
-def _hash_text(s):
-    return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
-
-# Table of hash values for escaped characters:
-g_escape_table = dict([(ch, _hash_text(ch))
-    for ch in '\\`*_{}[]()>#+-.!'])
+    As a class attribute it replaces itself on the class with the compiled
+    regex on first access, so that it is shared by all instances at no
+    further cost. Elsewhere attribute access is passed through to the
+    compiled regex.
+    """
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self._regex = None
+
+    def _compile(self):
+        if self._regex is None:
+            self._regex = re.compile(self.pattern, self.flags)
+        return self._regex
+
+    def __get__(self, obj, cls):
+        regex = self._compile()
+        for klass in cls.__mro__:
+            for name, value in list(vars(klass).items()):
+                if value is self:
+                    setattr(klass, name, regex)
+                    return regex
+        return regex
+
+    def __getattr__(self, name):
+        return getattr(self._compile(), name)
+
+
+# Characters that can be backslash-escaped in Markdown.
+g_escape_chars = '\\`*_{}[]()>#+-.!'
+
+def _free_placeholder_prefix(text):
+    """Return a prefix for placeholder tokens that can't occur in `text`.
+
+    The prefix is "xmdq" plus as many more "q"s as it takes for everything
+    after its leading "x" to be absent from `text`, so no placeholder can be
+    formed by a placeholder's trailing "x" and the text that follows it.
+    """
+    prefix = "xmdq"
+    while prefix[1:] in text:
+        prefix += "q"
+    return prefix
 
 
 
@@ -173,6 +205,74 @@ def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
                     link_patterns=link_patterns,
                     use_file_vars=use_file_vars).convert(text)
 
+def convert_many(docs, paths=False, encoding="utf-8", jobs=None,
+                 html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                 safe_mode=None, extras=None, link_patterns=None,
+                 use_file_vars=False):
+    """Convert many markdown documents with the same options.
+
+    One `Markdown` instance is used for all the documents (it is reset
+    for each), rather than one per document as with `markdown()`.
+
+    @param docs {iterable} The markdown texts to convert, or the paths of
+        markdown files if `paths` is true.
+    @param paths {bool} Whether `docs` are paths of files to read (with
+        the given `encoding`).
+    @param jobs {int} If more than 1, the documents are converted over a
+        pool of this many worker processes, each with its own `Markdown`
+        instance. The remaining arguments are as for `markdown()` and
+        must be picklable in this case.
+    @returns A generator of the converted HTML of each doc, in order.
+    """
+    options = dict(html4tags=html4tags, tab_width=tab_width,
+                   safe_mode=safe_mode, extras=extras,
+                   link_patterns=link_patterns, use_file_vars=use_file_vars)
+    if not paths:
+        encoding = None
+    if jobs is not None and jobs > 1:
+        docs = list(docs)
+        jobs = min(jobs, len(docs))
+    if jobs is None or jobs <= 1:
+        markdowner = Markdown(**options)
+        for doc in docs:
+            yield _convert_doc(markdowner, doc, encoding)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs, _init_convert_worker, (options,))
+    results = pool.imap(_convert_in_worker,
+                        [(doc, encoding) for doc in docs])
+    pool.close()
+    try:
+        for html in results:
+            yield html
+    except:
+        # A conversion failed or the caller stopped iterating. Let the
+        # workers finish up rather than `terminate()` the pool, which can
+        # deadlock on Python 2.
+        _drain_results(results)
+        pool.join()
+        raise
+    pool.join()
+
+def format_timings(timings):
+    """Format the stage timings recorded by `Markdown.record_timings()`
+    as a table, slowest stage first.
+    """
+    total = 0.0
+    for calls, seconds in timings.values():
+        total += seconds
+    lines = ["%-26s %8s %10s %6s" % ("STAGE", "CALLS", "TIME", "%")]
+    items = [(seconds, name, calls)
+             for name, (calls, seconds) in timings.items()]
+    items.sort()
+    items.reverse()
+    for seconds, name, calls in items:
+        lines.append("%-26s %8d %9.2fms %5.1f%%" % (name, calls,
+            seconds * 1000.0, total and seconds * 100.0 / total))
+    lines.append("%-26s %8s %9.2fms" % ("total", "", total * 1000.0))
+    return "\n".join(lines)
+
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
     # extra name to argument for the extra. Most extras do not have an
@@ -192,7 +292,7 @@ class Markdown(object):
     # (see _ProcessListItems() for details):
     list_level = 0
 
-    _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
+    _ws_only_line_re = _lazy_re(r"^[ \t]+$", re.M)
 
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
                  extras=None, link_patterns=None, use_file_vars=False):
@@ -226,12 +326,7 @@ class Markdown(object):
 
         self.link_patterns = link_patterns
         self.use_file_vars = use_file_vars
-        self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
-
-        self._escape_table = g_escape_table.copy()
-        if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+        self._outdent_re = _outdent_re_from_tab_width(tab_width)
 
     def reset(self):
         self.urls = {}
@@ -245,16 +340,275 @@ class Markdown(object):
             self.footnote_ids = []
         if "header-ids" in self.extras:
             self._count_from_header_id = {} # no `defaultdict` in Python 2.4
+            self._toc = None
         if "metadata" in self.extras:
             self.metadata = {}
 
+    def _init_placeholders(self, text):
+        """Set up the placeholder tokens for converting `text`.
+
+        Placeholders (for hashed HTML blocks and spans, code spans and
+        escaped characters) are numbered from a per-conversion counter and
+        start with a prefix that does not occur in `text`, so they can't
+        collide with the document. As with the md5-based hashes they
+        replace, equal strings get the same placeholder, and placeholders
+        are made of word characters only, so regexes like the email
+        auto-link one that match `\w` runs match across them. Any that
+        leak into the output are plain ASCII.
+        """
+        self._placeholder_prefix = _free_placeholder_prefix(text)
+        self._placeholder_from_text = {}
+        self._escape_table = dict([(ch, self._hash_text(ch))
+            for ch in g_escape_chars])
+        if "smarty-pants" in self.extras:
+            self._escape_table['"'] = self._hash_text('"')
+            self._escape_table["'"] = self._hash_text("'")
+        self._code_table = {}
+
+        # Regexes to swap in and out the escaped chars in one pass.
+        self._backslash_escape_re = re.compile(r'\\([%s])'
+            % re.escape(''.join(self._escape_table)))
+        self._placeholder_re = re.compile(
+            re.escape(self._placeholder_prefix) + '[0-9a-f]+x')
+        self._unescaped_from_placeholder = dict([(hash, ch)
+            for ch, hash in self._escape_table.items()])
+
+    def _hash_text(self, s):
+        """Return the placeholder for string `s` in this conversion."""
+        try:
+            return self._placeholder_from_text[s]
+        except KeyError:
+            key = self._placeholder_from_text[s] = "%s%xx" % (
+                self._placeholder_prefix, len(self._placeholder_from_text))
+            return key
+
+    # The stages of conversion that `record_timings()` times: the method and
+    # the stage name (the extra's name for extras).
+    _timed_stages = [
+        ("convert", "convert"),
+        ("_prepare", "prepare"),
+        ("_detab", "detab"),
+        ("_extract_metadata", "metadata"),
+        ("_hash_html_spans", "hash_html_spans"),
+        ("_hash_html_blocks", "hash_html_blocks"),
+        ("_strip_footnote_definitions", "footnotes"),
+        ("_strip_link_definitions", "strip_link_definitions"),
+        ("_run_block_gamut", "block_gamut"),
+        ("_do_fenced_code_blocks", "fenced-code-blocks"),
+        ("_do_headers", "do_headers"),
+        ("header_id_from_text", "header-ids"),
+        ("_toc_add_entry", "toc"),
+        ("_do_lists", "do_lists"),
+        ("_prepare_pyshell_blocks", "pyshell"),
+        ("_do_wiki_tables", "wiki-tables"),
+        ("_do_code_blocks", "do_code_blocks"),
+        ("_color_with_pygments", "code-color"),
+        ("_do_block_quotes", "do_block_quotes"),
+        ("_form_paragraphs", "form_paragraphs"),
+        ("_run_span_gamut", "span_gamut"),
+        ("_do_code_spans", "do_code_spans"),
+        ("_escape_special_chars", "escape_special_chars"),
+        ("_encode_backslash_escapes", "encode_backslash_escapes"),
+        ("_do_links", "do_links"),
+        ("_do_auto_links", "do_auto_links"),
+        ("_do_link_patterns", "link-patterns"),
+        ("_encode_amps_and_angles", "encode_amps_and_angles"),
+        ("_do_italics_and_bold", "do_italics_and_bold"),
+        ("_do_smart_punctuation", "smarty-pants"),
+        ("_add_footnotes", "footnotes"),
+        ("postprocess", "postprocess"),
+        ("_unescape_special_chars", "unescape_special_chars"),
+        ("_unhash_html_spans", "unhash_html_spans"),
+    ]
+
+    timings = None
+
+    def record_timings(self, timings=None):
+        """Record the number of calls to and the time spent in each stage
+        of converting text with this instance.
+
+        A stage's time is its own: it doesn't include the time of the
+        stages it calls (e.g. a list's items go through the block gamut
+        again), so the times add up to the total. Stages run in the
+        workers of `convert_parallel()` are not recorded. Set `timings` to
+        None to stop recording.
+
+        @param timings {dict} The dict to add the timings to. A new one is
+            used if not given.
+        @returns {dict} `self.timings`: a mapping of stage name to a list
+            of the number of calls and the seconds spent in it. See
+            `format_timings()`.
+        """
+        if timings is None:
+            timings = {}
+        self.timings = timings
+        if getattr(self, "_timing_stack", None) is None:
+            import time
+            timer = getattr(time, "perf_counter", time.time)
+            self._timing_stack = []
+            for attr, name in self._timed_stages:
+                setattr(self, attr,
+                    _timed_stage(self, name, getattr(self, attr), timer))
+        return timings
+
+    def convert_many(self, texts):
+        """Convert each of the given texts, reusing this instance.
+
+        @returns A generator of the converted HTML of each text.
+        """
+        for text in texts:
+            yield self.convert(text)
+
     def convert(self, text):
         """Convert the given text."""
         # Main function. The order in which other subs are called here is
         # essential. Link and image substitutions need to happen before
         # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
         # and <img> tags get encoded.
+        text = self._prepare(text)
+        return self._convert_prepared(text)
+
+    # Where `convert_parallel()` can split a document: before a top-level
+    # (h1) atx header that follows a blank line.
+    _chunk_split_re = _lazy_re(r"\n\n(?=#(?!#))")
+
+    # The smallest chunk `convert_parallel()` will hand to a worker.
+    _min_chunk_size = 32 * 1024
+
+    # A standalone HTML comment stops being hashed at the first "<!--" that
+    # doesn't follow a blank line.
+    _comments_stop_re = _lazy_re(r"(?<!\n\n)<!--")
+
+    def convert_parallel(self, text, jobs=None):
+        """Convert the given text, converting chunks of it in parallel over
+        a pool of `jobs` worker processes (default is the number of CPUs).
+
+        The result is the same as for `convert()`. The text is split at
+        top-level headers, after its raw HTML blocks and link definitions
+        have been gathered from the whole document and shared with the
+        workers. Each worker notes the HTML tags and comments in its chunk
+        that a later chunk could close; if one does, the text is converted
+        serially instead. Likewise if a chunk's HTML has a placeholder
+        left in it that was numbered in its worker (and so not as
+        `convert()` would number it). Some features need the whole
+        document: the "footnotes", "header-ids" and "toc" extras and an
+        overridden `postprocess()`. With those, or for a small document,
+        the text is converted serially.
+        """
+        import multiprocessing
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        source = text
+        text = self._prepare(text)
+        if (jobs <= 1 or "footnotes" in self.extras
+            or "header-ids" in self.extras
+            or type(self).postprocess != Markdown.postprocess):
+            return self._convert_prepared(text)
+
+        chunks = self._split_chunks(text, jobs * 4)
+        if len(chunks) == 1:
+            return self._convert_prepared(text)
+
+        # Whether comments are still hashed in a chunk depends on the chunks
+        # before it. Guess from the prepared text and redo a chunk (with
+        # comments) below if that was wrong.
+        match = self._comments_stop_re.search(text)
+        if match:
+            stop = match.start()
+        else:
+            stop = len(text)
+        tasks = []
+        start = 0
+        for chunk in chunks:
+            tasks.append((chunk, start <= stop))
+            start += len(chunk)
+
+        jobs = min(jobs, len(chunks))
+        log.debug("convert %d chunks with %d workers", len(chunks), jobs)
+        # The workers get this instance, with the state of the prepared
+        # text, when the pool is created.
+        pool = multiprocessing.Pool(jobs, _init_chunk_worker, (self,))
+        try:
+            results = pool.map(_convert_chunk_in_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        htmls = []
+        comments = True
+        unclosed = set()
+        # Placeholders made in `_prepare()` are numbered as for `convert()`.
+        # Those made for a chunk are numbered from here in its worker (or
+        # here, for a chunk redone below), so converting serially starts
+        # over with `convert()`.
+        prepared = set(self._placeholder_from_text.values())
+        for (chunk, guess), (html, state) in zip(tasks, results):
+            if guess != comments and state["has_comments"]:
+                html, state = self._convert_chunk(chunk, comments)
+            if unclosed & state["closes"]:
+                log.debug("HTML block spans chunks: convert serially")
+                return self.convert(source)
+            if self._placeholder_prefix in html:
+                for placeholder in self._placeholder_re.findall(html):
+                    if placeholder not in prepared:
+                        log.debug("placeholder left in chunk: convert "
+                                  "serially")
+                        return self.convert(source)
+            unclosed.update(state["unclosed"])
+            if state["has_comments"]:
+                comments = state["comments"]
+            htmls.append(html)
+        return self._finish("\n\n".join(htmls))
+
+    def _split_chunks(self, text, max_chunks):
+        """Split prepared text into at most about `max_chunks` chunks for
+        `convert_parallel()`.
+        """
+        # Don't split in a fenced code block.
+        spans = []
+        if "fenced-code-blocks" in self.extras:
+            spans = [match.span()
+                for match in self._fenced_code_block_re.finditer(text)]
+
+        chunk_size = max(len(text) // max_chunks, self._min_chunk_size)
+        chunks = []
+        start = 0
+        for match in self._chunk_split_re.finditer(text):
+            end = match.end()
+            if end - start < chunk_size:
+                continue
+            for span_start, span_end in spans:
+                if span_start < end <= span_end:
+                    break
+            else:
+                if text[start:end].strip():
+                    chunks.append(text[start:end])
+                    start = end
+        chunks.append(text[start:])
+        return chunks
+
+    def _convert_chunk(self, text, comments):
+        """Convert a chunk of prepared text for `convert_parallel()`.
+
+        @param comments {boolean} indicates if standalone HTML comments are
+            still hashed at the start of this chunk.
+        @returns {tuple} The HTML and the state of the chunk: the end tags
+            ("closes") and unclosed start tags and comments ("unclosed") it
+            has, and whether it "has_comments" and they are still hashed
+            after it ("comments").
+        """
+        chunk = {"comments": comments, "has_comments": False,
+                 "closes": set(), "unclosed": set()}
+        text = self._run_block_gamut(text, chunk)
+        text = self._unescape_special_chars(text)
+        if self.safe_mode:
+            text = self._unhash_html_spans(text)
+        return text, chunk
 
+    def _prepare(self, text):
+        """Reset for converting the given text and do the passes over the
+        whole of it that precede the block gamut.
+        """
         # Clear the global hashes. If we don't clear these, you get conflicts
         # from other articles when generating a page which contains more than
         # one article (e.g. an index page that shows the N most recent
@@ -281,6 +635,8 @@ class Markdown(object):
                         ename, earg = e, None
                     self.extras[ename] = earg
 
+        self._init_placeholders(text)
+
         # Standardize line endings:
         text = re.sub("\r\n|\r", "\n", text)
 
@@ -313,7 +669,10 @@ class Markdown(object):
             #   [^4]: this "looks like a link defn"
             text = self._strip_footnote_definitions(text)
         text = self._strip_link_definitions(text)
+        return text
 
+    def _convert_prepared(self, text):
+        """Convert text prepared by `_prepare()`."""
         text = self._run_block_gamut(text)
 
         if "footnotes" in self.extras:
@@ -326,6 +685,9 @@ class Markdown(object):
         if self.safe_mode:
             text = self._unhash_html_spans(text)
 
+        return self._finish(text)
+
+    def _finish(self, text):
         text += "\n"
 
         rv = UnicodeWithAttrs(text)
@@ -348,7 +710,7 @@ class Markdown(object):
     #   foo: bar
     #   another-var: blah blah
     #   ---
-    _metadata_pat = re.compile("""^---[ \t]*\n((?:[ \t]*[^ \t:]+[ \t]*:[^\n]*\n)+)---[ \t]*\n""")
+    _metadata_pat = _lazy_re("""^---[ \t]*\n((?:[ \t]*[^ \t:]+[ \t]*:[^\n]*\n)+)---[ \t]*\n""")
 
     def _extract_metadata(self, text):
         # fast test
@@ -367,7 +729,7 @@ class Markdown(object):
         return tail
 
 
-    _emacs_oneliner_vars_pat = re.compile(r"-\*-\s*([^\r\n]*?)\s*-\*-", re.UNICODE)
+    _emacs_oneliner_vars_pat = _lazy_re(r"-\*-\s*([^\r\n]*?)\s*-\*-", re.UNICODE)
     # This regular expression is intended to match blocks like this:
     #    PREFIX Local Variables: SUFFIX
     #    PREFIX mode: Tcl SUFFIX
@@ -376,7 +738,7 @@ class Markdown(object):
     # - "[ \t]" is used instead of "\s" to specifically exclude newlines
     # - "(\r\n|\n|\r)" is used instead of "$" because the sre engine does
     #   not like anything other than Unix-style line terminators.
-    _emacs_local_vars_pat = re.compile(r"""^
+    _emacs_local_vars_pat = _lazy_re(r"""^
         (?P<prefix>(?:[^\r\n|\n|\r])*?)
         [\ \t]*Local\ Variables:[\ \t]*
         (?P<suffix>.*?)(?:\r\n|\n|\r)
@@ -486,7 +848,7 @@ class Markdown(object):
 
     # Cribbed from a post by Bart Lateur:
     # <http://www.nntp.perl.org/group/perl.macperl.anyperl/154>
-    _detab_re = re.compile(r'(.*?)\t', re.M)
+    _detab_re = _lazy_re(r'(.*?)\t', re.M)
     def _detab_sub(self, match):
         g1 = match.group(1)
         return g1 + (' ' * (self.tab_width - len(g1) % self.tab_width))
@@ -516,39 +878,93 @@ class Markdown(object):
     _block_tags_a = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math|ins|del'
     _block_tags_a += _html5tags
 
-    _strict_tag_block_re = re.compile(r"""
-        (                       # save in \1
-            ^                   # start of line  (with re.M)
-            <(%s)               # start tag = \2
-            \b                  # word break
-            (.*\n)*?            # any number of lines, minimally matching
-            </\2>               # the matching end tag
-            [ \t]*              # trailing spaces/tabs
-            (?=\n+|\Z)          # followed by a newline or end of document
-        )
-        """ % _block_tags_a,
-        re.X | re.M)
+    # Block-level HTML "tag blocks" (see `_hash_tag_blocks()`) open with a
+    # block tag at the start of a line and end at the first line after it
+    # that is only the matching end tag ("strict"), or at the first line
+    # ending with the matching end tag ("liberal"), e.g.:
+    #   <div>                   <div><p>
+    #       <div>               foo</p></div>
+    #       </div>
+    #   </div>
+    # Matching those with a regex -- `^<(tag)\b(.*\n)*?</\1>` -- backtracks
+    # over the rest of the document for every unclosed tag.
+    _strict_tag_open_re = _lazy_re(r'^<(%s)\b' % _block_tags_a, re.M)
+    _strict_tag_close_re = _lazy_re(r'^</(%s)>[ \t]*$' % _block_tags_a, re.M)
 
     _block_tags_b = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math'
     _block_tags_b += _html5tags
 
-    _liberal_tag_block_re = re.compile(r"""
-        (                       # save in \1
-            ^                   # start of line  (with re.M)
-            <(%s)               # start tag = \2
-            \b                  # word break
-            (.*\n)*?            # any number of lines, minimally matching
-            .*</\2>             # the matching end tag
-            [ \t]*              # trailing spaces/tabs
-            (?=\n+|\Z)          # followed by a newline or end of document
-        )
-        """ % _block_tags_b,
-        re.X | re.M)
+    _liberal_tag_open_re = _lazy_re(r'^<(%s)\b' % _block_tags_b, re.M)
+    _liberal_tag_close_re = _lazy_re(r'</(%s)>[ \t]*$' % _block_tags_b, re.M)
+
+    _tag_close_tail_re = _lazy_re(r'[ \t]*$', re.M)
+
+    def _hash_tag_blocks(self, text, strict, raw=False, chunk=None):
+        """Hash the block-level HTML tag blocks in `text`.
+
+        This finds blocks in one pass over `text`: the end tags are indexed
+        up front and each block's end is then looked up with a binary search,
+        so the cost is bounded by O(n log n) even when tags are unclosed.
+
+        @param chunk {dict} is the state of the chunk being converted, if
+            this is a chunk in a `convert_parallel()` worker. The end tags
+            and unclosed start tags are noted in it.
+        """
+        if strict:
+            open_re = self._strict_tag_open_re
+            close_re = self._strict_tag_close_re
+            kind = "strict"
+        else:
+            open_re = self._liberal_tag_open_re
+            close_re = self._liberal_tag_close_re
+            kind = "liberal"
+
+        # Start and end offsets of the end tags for each tag name.
+        closes_from_tag = {}
+        for match in close_re.finditer(text):
+            starts, ends = closes_from_tag.setdefault(match.group(1), ([], []))
+            starts.append(match.start())
+            ends.append(match.end())
+        if chunk is not None:
+            chunk["closes"].update([(kind, tag) for tag in closes_from_tag])
+
+        pieces = []
+        pos = 0
+        for match in open_re.finditer(text):
+            start = match.start()
+            tag = match.group(1)
+            if start < pos:
+                continue
+            end = None
+            if strict and text.startswith("</%s>" % tag, match.end()):
+                # The end tag directly follows the start tag: "<p</p>".
+                m = self._tag_close_tail_re.match(text,
+                    match.end() + len(tag) + 3)
+                if m:
+                    end = m.end()
+            if end is None and tag in closes_from_tag:
+                starts, ends = closes_from_tag[tag]
+                i = bisect_left(starts, match.end())
+                if i < len(starts):
+                    end = ends[i]
+            if end is None:
+                if chunk is not None:
+                    chunk["unclosed"].add((kind, tag))
+                continue
+            pieces.append(text[pos:start])
+            pieces.append(self._hash_html_block(text[start:end], raw))
+            pos = end
+        if not pieces:
+            return text
+        pieces.append(text[pos:])
+        return ''.join(pieces)
 
-    _html_markdown_attr_re = re.compile(
+    _html_markdown_attr_re = _lazy_re(
         r'''\s+markdown=("1"|'1')''')
     def _hash_html_block_sub(self, match, raw=False):
-        html = match.group(1)
+        return self._hash_html_block(match.group(1), raw)
+
+    def _hash_html_block(self, html, raw=False):
         if raw and self.safe_mode:
             html = self._sanitize_html(html)
         elif 'markdown-in-html' in self.extras and 'markdown=' in html:
@@ -559,18 +975,18 @@ class Markdown(object):
                 middle = '\n'.join(lines[1:-1])
                 last_line = lines[-1]
                 first_line = first_line[:m.start()] + first_line[m.end():]
-                f_key = _hash_text(first_line)
+                f_key = self._hash_text(first_line)
                 self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
+                l_key = self._hash_text(last_line)
                 self.html_blocks[l_key] = last_line
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
-        key = _hash_text(html)
+        key = self._hash_text(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
-    def _hash_html_blocks(self, text, raw=False):
+    def _hash_html_blocks(self, text, raw=False, chunk=None):
         """Hashify HTML blocks
 
         We only want to do this for block-level HTML tags, such as headers,
@@ -581,6 +997,9 @@ class Markdown(object):
 
         @param raw {boolean} indicates if these are raw HTML blocks in
             the original source. It makes a difference in "safe" mode.
+        @param chunk {dict} is the state of the chunk being converted, if
+            this is a chunk in a `convert_parallel()` worker (see
+            `_convert_chunk()`).
         """
         if '<' not in text:
             return text
@@ -599,10 +1018,10 @@ class Markdown(object):
         # the inner nested divs must be indented.
         # We need to do this before the next, more liberal match, because the next
         # match will start at the first `<div>` and stop at the first `</div>`.
-        text = self._strict_tag_block_re.sub(hash_html_block_sub, text)
+        text = self._hash_tag_blocks(text, strict=True, raw=raw, chunk=chunk)
 
         # Now match more liberally, simply from `\n<tag>` to `</tag>\n`
-        text = self._liberal_tag_block_re.sub(hash_html_block_sub, text)
+        text = self._hash_tag_blocks(text, strict=False, raw=raw, chunk=chunk)
 
         # Special case just for <hr />. It was easier to make a special
         # case than to make the other regex more complicated.
@@ -611,7 +1030,13 @@ class Markdown(object):
             text = _hr_tag_re.sub(hash_html_block_sub, text)
 
         # Special case for standalone HTML comments:
-        if "<!--" in text:
+        if chunk is not None:
+            chunk["has_comments"] = "<!--" in text
+            if "-->" in text:
+                chunk["closes"].add("comment")
+        if "<!--" in text and (chunk is None or chunk["comments"]):
+            pieces = []
+            pos = 0     # end of the last hashed comment block
             start = 0
             while True:
                 # Delimiters for next comment block.
@@ -622,6 +1047,8 @@ class Markdown(object):
                 try:
                     end_idx = text.index("-->", start_idx) + 3
                 except ValueError:
+                    if chunk is not None:
+                        chunk["unclosed"].add("comment")
                     break
 
                 # Start position for next comment block search.
@@ -645,6 +1072,10 @@ class Markdown(object):
                     elif text[start_idx-2:start_idx] == '\n\n':
                         pass
                     else:
+                        # No more comments are hashed, in this chunk or
+                        # those after it.
+                        if chunk is not None:
+                            chunk["comments"] = False
                         break
 
                 # Validate whitespace after comment.
@@ -661,9 +1092,13 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._hash_text(html)
                 self.html_blocks[key] = html
-                text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
+                pieces += [text[pos:start_idx], "\n\n", key, "\n\n"]
+                pos = end_idx
+            if pieces:
+                pieces.append(text[pos:])
+                text = ''.join(pieces)
 
         if "xml" in self.extras:
             # Treat XML processing instructions and namespaced one-liner
@@ -681,28 +1116,7 @@ class Markdown(object):
     def _strip_link_definitions(self, text):
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
-        less_than_tab = self.tab_width - 1
-
-        # Link defs are in the form:
-        #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
-            ^[ ]{0,%d}\[(.+)\]: # id = \1
-              [ \t]*
-              \n?               # maybe *one* newline
-              [ \t]*
-            <?(.+?)>?           # url = \2
-              [ \t]*
-            (?:
-                \n?             # maybe one newline
-                [ \t]*
-                (?<=\s)         # lookbehind for whitespace
-                ['"(]
-                ([^\n]*)        # title = \3
-                ['")]
-                [ \t]*
-            )?  # title is optional
-            (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
+        _link_def_re = _link_def_re_from_tab_width(self.tab_width)
         return _link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match):
@@ -737,32 +1151,23 @@ class Markdown(object):
             [^note-id]:
                 Text of the note.
         """
-        less_than_tab = self.tab_width - 1
-        footnote_def_re = re.compile(r'''
-            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
-            [ \t]*
-            (                       # footnote text = \2
-              # First line need not start with the spaces.
-              (?:\s*.*\n+)
-              (?:
-                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
-                .*\n+
-              )*
-            )
-            # Lookahead for non-space at line-start, or end of doc.
-            (?:(?=^[ ]{0,%d}\S)|\Z)
-            ''' % (less_than_tab, self.tab_width, self.tab_width),
-            re.X | re.M)
+        footnote_def_re = _footnote_def_re_from_tab_width(self.tab_width)
         return footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
 
     _hr_data = [
-        ('*', re.compile(r"^[ ]{0,3}\*(.*?)$", re.M)),
-        ('-', re.compile(r"^[ ]{0,3}\-(.*?)$", re.M)),
-        ('_', re.compile(r"^[ ]{0,3}\_(.*?)$", re.M)),
+        ('*', _lazy_re(r"^[ ]{0,3}\*(.*?)$", re.M)),
+        ('-', _lazy_re(r"^[ ]{0,3}\-(.*?)$", re.M)),
+        ('_', _lazy_re(r"^[ ]{0,3}\_(.*?)$", re.M)),
     ]
 
-    def _run_block_gamut(self, text):
+    def _hr_sub(self, match, ch):
+        tail = match.group(1).rstrip()
+        if not tail.strip(ch + ' ') and tail.count("   ") == 0:
+            return "\n<hr"+self.empty_element_suffix+"\n"
+        return match.group(0)
+
+    def _run_block_gamut(self, text, chunk=None):
         # These are all the transformations that form block-level
         # tags like paragraphs, headers, and list items.
 
@@ -776,14 +1181,9 @@ class Markdown(object):
         # you wish, you may use spaces between the hyphens or asterisks."
         # Markdown.pl 1.0.1's hr regexes limit the number of spaces between the
         # hr chars to one or two. We'll reproduce that limit here.
-        hr = "\n<hr"+self.empty_element_suffix+"\n"
         for ch, regex in self._hr_data:
             if ch in text:
-                for m in reversed(list(regex.finditer(text))):
-                    tail = m.group(1).rstrip()
-                    if not tail.strip(ch + ' ') and tail.count("   ") == 0:
-                        start, end = m.span()
-                        text = text[:start] + hr + text[end:]
+                text = regex.sub(_curry(self._hr_sub, ch=ch), text)
 
         text = self._do_lists(text)
 
@@ -800,7 +1200,7 @@ class Markdown(object):
         # was to escape raw HTML in the original Markdown source. This time,
         # we're escaping the markup we've just created, so that we don't wrap
         # <p> tags around block-level tags.
-        text = self._hash_html_blocks(text)
+        text = self._hash_html_blocks(text, chunk=chunk)
 
         text = self._form_paragraphs(text)
 
@@ -822,13 +1222,7 @@ class Markdown(object):
         if ">>>" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        _pyshell_block_re = re.compile(r"""
-            ^([ ]{0,%d})>>>[ ].*\n   # first line
-            ^(\1.*\S+.*\n)*         # any number of subsequent lines
-            ^\n                     # ends with a blank line
-            """ % less_than_tab, re.M | re.X)
-
+        _pyshell_block_re = _pyshell_block_re_from_tab_width(self.tab_width)
         return _pyshell_block_re.sub(self._pyshell_block_sub, text)
 
     def _wiki_table_sub(self, match):
@@ -857,47 +1251,62 @@ class Markdown(object):
         if "||" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        wiki_table_re = re.compile(r'''
-            (?:(?<=\n\n)|\A\n?)            # leading blank line
-            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
-            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
-            ''' % less_than_tab, re.M | re.X)
+        wiki_table_re = _wiki_table_re_from_tab_width(self.tab_width)
         return wiki_table_re.sub(self._wiki_table_sub, text)
 
     def _run_span_gamut(self, text):
         # These are all the transformations that occur *within* block-level
         # tags like paragraphs, headers, and list items.
+        #
+        # Most of these are skipped for text without the characters they act
+        # on (most paragraphs are plain prose). Whether there is HTML is
+        # decided before code spans are done: the <code> tags they add are
+        # left alone by all the later transformations.
+        has_html = '<' in text
+        has_angles = has_html or '>' in text
 
-        text = self._do_code_spans(text)
+        if '`' in text: # guard for perf
+            text = self._do_code_spans(text)
 
-        text = self._escape_special_chars(text)
+        if has_html:
+            text = self._escape_special_chars(text)
+        elif '\\' in text: # guard for perf
+            text = self._encode_backslash_escapes(text)
 
         # Process anchor and image tags.
+        before_links = text
         text = self._do_links(text)
 
         # Make links out of things like `<http://example.com/>`
         # Must come after _do_links(), because you can use < and >
         # delimiters in inline links like [this](<url>).
-        text = self._do_auto_links(text)
+        if has_html:
+            text = self._do_auto_links(text)
 
         if "link-patterns" in self.extras:
             text = self._do_link_patterns(text)
 
-        text = self._encode_amps_and_angles(text)
+        # Added links can bring in '&', '<' and '>' from link definitions.
+        if has_angles or '&' in text or text is not before_links:
+            text = self._encode_amps_and_angles(text)
 
-        text = self._do_italics_and_bold(text)
+        if '*' in text or '_' in text: # guard for perf
+            text = self._do_italics_and_bold(text)
 
         if "smarty-pants" in self.extras:
             text = self._do_smart_punctuation(text)
 
         # Do hard breaks:
-        text = re.sub(r" {2,}\n", " <br%s\n" % self.empty_element_suffix, text)
+        if "  \n" in text: # guard for perf
+            text = self._hard_break_re.sub(
+                " <br%s\n" % self.empty_element_suffix, text)
 
         return text
 
+    _hard_break_re = _lazy_re(r" {2,}\n")
+
     # "Sorta" because auto-links are identified as "tag" tokens.
-    _sorta_html_tokenize_re = re.compile(r"""
+    _sorta_html_tokenize_re = _lazy_re(r"""
         (
             # tag
             </?
@@ -928,9 +1337,7 @@ class Markdown(object):
                 # Within tags/HTML-comments/auto-links, encode * and _
                 # so they don't conflict with their use in Markdown for
                 # italics and strong.  We're replacing each such
-                # character with its corresponding MD5 checksum value;
-                # this is likely overkill, but it should prevent us from
-                # colliding with the escape values by accident.
+                # character with its placeholder (see `_hash_text()`).
                 escaped.append(token.replace('*', self._escape_table['*'])
                                     .replace('_', self._escape_table['_']))
             else:
@@ -953,7 +1360,7 @@ class Markdown(object):
         for token in self._sorta_html_tokenize_re.split(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
+                key = self._hash_text(sanitized)
                 self.html_spans[key] = sanitized
                 tokens.append(key)
             else:
@@ -982,7 +1389,7 @@ class Markdown(object):
             raise MarkdownError("invalid value for 'safe_mode': %r (must be "
                                 "'escape' or 'replace')" % self.safe_mode)
 
-    _tail_of_inline_link_re = re.compile(r'''
+    _tail_of_inline_link_re = _lazy_re(r'''
           # Match tail of: [text](/url/) or [text](/url/ "title")
           \(            # literal paren
             [ \t]*
@@ -999,7 +1406,7 @@ class Markdown(object):
             )?                  # title is optional
           \)
         ''', re.X | re.S)
-    _tail_of_reference_link_re = re.compile(r'''
+    _tail_of_reference_link_re = _lazy_re(r'''
           # Match tail of: [text][id]
           [ ]?          # one optional space
           (?:\n[ ]*)?   # one optional newline followed by spaces
@@ -1017,14 +1424,44 @@ class Markdown(object):
         Markdown.pl because of the lack of atomic matching support in
         Python's regex engine used in $g_nested_brackets.
         """
+        if '[' not in text:
+            return text
+
+        # The result is built up in `pieces`. Matching brackets are found
+        # up front in one pass over `text`.
+        pieces = []
+        self._do_links_in(text, pieces, _closing_bracket_from_idx(text))
+        return ''.join(pieces)
+
+    def _do_links_in(self, text, pieces, closing_bracket_from_idx, base=0,
+                     rest=None, rest_pos=0):
+        """Convert the links in `text`, adding the result to `pieces`.
+
+        This is also used for the link text of an anchor, which may have
+        images in it (e.g. `[![alt](src)](url)`). Then `text` is the link
+        text plus '</a>', in which anchors aren't allowed; its brackets
+        are at offset `base` in `closing_bracket_from_idx`; and the rest of
+        the document follows from `rest[rest_pos:]`.
+
+        @returns {int} For link text, the position in `rest` to carry on
+            from: `rest_pos`, unless the tail of an image ran on past the
+            end of the link text.
+        """
         MAX_LINK_TEXT_SENTINEL = 3000  # markdown2 issue 24
 
+        # `text[:emitted]` has been converted and added to `pieces`.
+        emitted = 0
+
         # `anchor_allowed_pos` is used to support img links inside
         # anchors, but not anchors inside anchors. An anchor's start
         # pos must be `>= anchor_allowed_pos`.
-        anchor_allowed_pos = 0
+        if rest is None:
+            anchor_allowed_pos = 0
+        else:
+            anchor_allowed_pos = len(text)
 
         curr_pos = 0
+        text_length = len(text)
         while True: # Handle the next link.
             # The next '[' is the start of:
             # - an inline anchor:   [text](url "title")
@@ -1045,28 +1482,19 @@ class Markdown(object):
                 start_idx = text.index('[', curr_pos)
             except ValueError:
                 break
-            text_length = len(text)
 
             # Find the matching closing ']'.
             # Markdown.pl allows *matching* brackets in link text so we
             # will here too. Markdown.pl *doesn't* currently allow
             # matching brackets in img alt text -- we'll differ in that
             # regard.
-            bracket_depth = 0
-            for p in range(start_idx+1, min(start_idx+MAX_LINK_TEXT_SENTINEL,
-                                            text_length)):
-                ch = text[p]
-                if ch == ']':
-                    bracket_depth -= 1
-                    if bracket_depth < 0:
-                        break
-                elif ch == '[':
-                    bracket_depth += 1
-            else:
+            p = closing_bracket_from_idx.get(base + start_idx)
+            if p is None or p - base - start_idx >= MAX_LINK_TEXT_SENTINEL:
                 # Closing bracket not found within sentinel length.
                 # This isn't markup.
                 curr_pos = start_idx + 1
                 continue
+            p -= base
             link_text = text[start_idx+1:p]
 
             # Possibly a footnote ref?
@@ -1077,7 +1505,8 @@ class Markdown(object):
                     result = '<sup class="footnote-ref" id="fnref-%s">' \
                              '<a href="#fn-%s">%s</a></sup>' \
                              % (normed_id, normed_id, len(self.footnote_ids))
-                    text = text[:start_idx] + result + text[p+1:]
+                    pieces += [text[emitted:start_idx], result]
+                    emitted = curr_pos = p+1
                 else:
                     # This id isn't defined, leave the markup alone.
                     curr_pos = p+1
@@ -1086,14 +1515,28 @@ class Markdown(object):
             # Now determine what this is by the remainder.
             p += 1
             if p == text_length:
-                return text
+                break
 
             # Inline anchor or img?
             if text[p] == '(': # attempt at perf improvement
-                match = self._tail_of_inline_link_re.match(text, p)
+                is_img = start_idx > 0 and text[start_idx-1] == "!"
+                if rest is None:
+                    match = self._tail_of_inline_link_re.match(text, p)
+                elif is_img:
+                    match = self._tail_of_inline_link_re.match(text, p)
+                    tail = match and text[p:match.end()] or ''
+                    if (not match or '"' in tail or "'" in tail
+                        or '<' in tail):
+                        # The tail might run on past the link text, so
+                        # match it against the rest of the document too.
+                        # (Rare: it is a plain "(url)" for most images.)
+                        match = self._tail_of_inline_link_re.match(
+                            text + rest[rest_pos:], p)
+                else:
+                    # Not an img, and no anchors allowed in link text.
+                    match = None
                 if match:
                     # Handle an inline anchor or img.
-                    is_img = start_idx > 0 and text[start_idx-1] == "!"
                     if is_img:
                         start_idx -= 1
 
@@ -1118,18 +1561,19 @@ class Markdown(object):
                                title_str, self.empty_element_suffix)
                         if "smarty-pants" in self.extras:
                             result = result.replace('"', self._escape_table['"'])
-                        curr_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[match.end():]
+                        pieces += [text[emitted:start_idx], result]
+                        emitted = curr_pos = match.end()
                     elif start_idx >= anchor_allowed_pos:
                         result_head = '<a href="%s"%s>' % (url, title_str)
-                        result = '%s%s</a>' % (result_head, link_text)
+                        result_tail = link_text + '</a>'
                         if "smarty-pants" in self.extras:
-                            result = result.replace('"', self._escape_table['"'])
-                        # <img> allowed from curr_pos on, <a> from
-                        # anchor_allowed_pos on.
-                        curr_pos = start_idx + len(result_head)
-                        anchor_allowed_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[match.end():]
+                            result_head = result_head.replace('"', self._escape_table['"'])
+                            result_tail = result_tail.replace('"', self._escape_table['"'])
+                        pieces += [text[emitted:start_idx], result_head]
+                        emitted = curr_pos = anchor_allowed_pos \
+                            = self._do_link_text_links(result_tail, pieces,
+                                closing_bracket_from_idx, start_idx + 1,
+                                text, match.end())
                     else:
                         # Anchor not allowed here.
                         curr_pos = start_idx + 1
@@ -1168,20 +1612,19 @@ class Markdown(object):
                                    title_str, self.empty_element_suffix)
                             if "smarty-pants" in self.extras:
                                 result = result.replace('"', self._escape_table['"'])
-                            curr_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
+                            pieces += [text[emitted:start_idx], result]
+                            emitted = curr_pos = match.end()
                         elif start_idx >= anchor_allowed_pos:
-                            result = '<a href="%s"%s>%s</a>' \
-                                % (url, title_str, link_text)
                             result_head = '<a href="%s"%s>' % (url, title_str)
-                            result = '%s%s</a>' % (result_head, link_text)
+                            result_tail = link_text + '</a>'
                             if "smarty-pants" in self.extras:
-                                result = result.replace('"', self._escape_table['"'])
-                            # <img> allowed from curr_pos on, <a> from
-                            # anchor_allowed_pos on.
-                            curr_pos = start_idx + len(result_head)
-                            anchor_allowed_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
+                                result_head = result_head.replace('"', self._escape_table['"'])
+                                result_tail = result_tail.replace('"', self._escape_table['"'])
+                            pieces += [text[emitted:start_idx], result_head]
+                            emitted = curr_pos = anchor_allowed_pos \
+                                = self._do_link_text_links(result_tail, pieces,
+                                    closing_bracket_from_idx, start_idx + 1,
+                                    text, match.end())
                         else:
                             # Anchor not allowed here.
                             curr_pos = start_idx + 1
@@ -1193,7 +1636,32 @@ class Markdown(object):
             # Otherwise, it isn't markup.
             curr_pos = start_idx + 1
 
-        return text
+        pieces.append(text[emitted:])
+        if rest is not None:
+            return rest_pos + max(0, emitted - text_length)
+
+    def _do_link_text_links(self, result_tail, pieces,
+                            closing_bracket_from_idx, link_text_idx,
+                            text, end):
+        """Add an anchor's `result_tail` (its link text plus '</a>') to
+        `pieces`, converting any images in the link text.
+
+        @param link_text_idx {int} The index of the link text in `text`.
+        @param end {int} The index in `text` of the end of the anchor.
+        @returns {int} The index in `text` to carry on from.
+        """
+        if '[' not in result_tail:
+            pieces.append(result_tail)
+            return end
+        if text.startswith(result_tail[:-4], link_text_idx):
+            # Link text is bracket-balanced, so its brackets match as they
+            # do in `text`: use offsets into the map for `text`.
+            return self._do_links_in(result_tail, pieces,
+                closing_bracket_from_idx, link_text_idx, text, end)
+        else:
+            # The link text was escaped for smarty-pants.
+            return self._do_links_in(result_tail, pieces,
+                _closing_bracket_from_idx(result_tail), 0, text, end)
 
     def header_id_from_text(self, text, prefix, n):
         """Generate a header id attribute value from the given header
@@ -1224,9 +1692,11 @@ class Markdown(object):
     def _toc_add_entry(self, level, id, name):
         if self._toc is None:
             self._toc = []
-        self._toc.append((level, id, name))
+        # `name` is converted header HTML: swap back any escaped characters
+        # and code spans so placeholders don't leak into `toc_html`.
+        self._toc.append((level, id, self._unescape_special_chars(name)))
 
-    _setext_h_re = re.compile(r'^(.+)[ \t]*\n(=+|-+)[ \t]*\n+', re.M)
+    _setext_h_re = _lazy_re(r'^(.+)[ \t]*\n(=+|-+)[ \t]*\n+', re.M)
     def _setext_h_sub(self, match):
         n = {"=": 1, "-": 2}[match.group(2)[0]]
         demote_headers = self.extras.get("demote-headers")
@@ -1243,7 +1713,7 @@ class Markdown(object):
             self._toc_add_entry(n, header_id, html)
         return "<h%d%s>%s</h%d>\n\n" % (n, header_id_attr, html, n)
 
-    _atx_h_re = re.compile(r'''
+    _atx_h_re = _lazy_re(r'''
         ^(\#{1,6})  # \1 = string of #'s
         [ \t]*
         (.+?)       # \2 = Header text
@@ -1305,42 +1775,26 @@ class Markdown(object):
     def _do_lists(self, text):
         # Form HTML ordered (numbered) and unordered (bulleted) lists.
 
-        # Iterate over each *non-overlapping* list match.
+        # Iterate over each *non-overlapping* list match, building the
+        # result in `pieces` (splicing each list into `text` in turn is
+        # quadratic for long documents).
+        #
+        # We match ul and ol separately to avoid adjacent lists of different
+        # types running into each other (see issue #16). Each style's next
+        # match is kept until we get past its start, so the text isn't
+        # rescanned for every list.
+        list_res = [_list_re_from_tab_width(self.tab_width, marker_pat,
+                                            bool(self.list_level))
+                    for marker_pat in (self._marker_ul, self._marker_ol)]
+        next_matches = [list_re.search(text) for list_re in list_res]
+        pieces = []
         pos = 0
         while True:
-            # Find the *first* hit for either list style (ul or ol). We
-            # match ul and ol separately to avoid adjacent lists of different
-            # types running into each other (see issue #16).
+            # Find the *first* hit for either list style (ul or ol).
             hits = []
-            for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        [ ]{0,%d}
-                        (%s)            # \3 = first list item marker
-                        [ \t]+
-                        (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \4
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
-                match = list_re.search(text, pos)
+            for i, match in enumerate(next_matches):
+                if match and match.start() < pos:
+                    match = next_matches[i] = list_res[i].search(text, pos)
                 if match:
                     hits.append((match.start(), match))
             if not hits:
@@ -1348,16 +1802,19 @@ class Markdown(object):
             hits.sort()
             match = hits[0][1]
             start, end = match.span()
-            text = text[:start] + self._list_sub(match) + text[end:]
+            pieces.append(text[pos:start])
+            pieces.append(self._list_sub(match))
             pos = end
+        if not pieces:
+            return text
+        pieces.append(text[pos:])
+        return ''.join(pieces)
 
-        return text
-
-    _list_item_re = re.compile(r'''
+    _list_item_re = _lazy_re(r'''
         (\n)?                   # leading line = \1
         (^[ \t]*)               # leading whitespace = \2
         (?P<marker>%s) [ \t]+   # list marker = \3
-        ((?:.+?)                # list item text = \4
+        ((?:.+?)?               # list item text = \4 (may be empty)
          (\n{1,2}))             # eols = \5
         (?= \n* (\Z | \2 (?P<next_marker>%s) [ \t]+))
         ''' % (_marker_any, _marker_any),
@@ -1494,20 +1951,10 @@ class Markdown(object):
 
     def _do_code_blocks(self, text):
         """Process Markdown `<pre><code>` blocks."""
-        code_block_re = re.compile(r'''
-            (?:\n\n|\A\n?)
-            (               # $1 = the code block -- one or more lines, starting with a space/tab
-              (?:
-                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
-                .*\n+
-              )+
-            )
-            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
-            ''' % (self.tab_width, self.tab_width),
-            re.M | re.X)
+        code_block_re = _code_block_re_from_tab_width(self.tab_width)
         return code_block_re.sub(self._code_block_sub, text)
 
-    _fenced_code_block_re = re.compile(r'''
+    _fenced_code_block_re = _lazy_re(r'''
         (?:\n\n|\A\n?)
         ^```([\w+-]+)?[ \t]*\n      # opening fence, $1 = optional lang
         (.*?)                       # $2 = code block content
@@ -1529,7 +1976,7 @@ class Markdown(object):
     #   space and that space will be removed in the emitted HTML
     # See `test/tm-cases/escapes.text` for a number of edge-case
     # examples.
-    _code_span_re = re.compile(r'''
+    _code_span_re = _lazy_re(r'''
             (?<!\\)
             (`+)        # \1 = Opening run of `
             (?!`)       # See Note A test/tm-cases/escapes.text
@@ -1574,24 +2021,18 @@ class Markdown(object):
         The point is that in code, these characters are literals,
         and lose their special Markdown meanings.
         """
-        replacements = [
-            # Encode all ampersands; HTML entities are not
-            # entities within a Markdown code span.
-            ('&', '&amp;'),
-            # Do the angle bracket song and dance:
-            ('<', '&lt;'),
-            ('>', '&gt;'),
-        ]
-        for before, after in replacements:
-            text = text.replace(before, after)
-        hashed = _hash_text(text)
-        self._escape_table[text] = hashed
+        # Encode all ampersands (HTML entities are not entities within a
+        # Markdown code span) and do the angle bracket song and dance.
+        if '&' in text or '<' in text or '>' in text: # guard for perf
+            text = _xml_special_chars_re.sub(_xml_escape_char_sub, text)
+        hashed = self._hash_text(text)
+        self._code_table[hashed] = text
         return hashed
 
-    _strong_re = re.compile(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
-    _em_re = re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
-    _code_friendly_strong_re = re.compile(r"\*\*(?=\S)(.+?[*_]*)(?<=\S)\*\*", re.S)
-    _code_friendly_em_re = re.compile(r"\*(?=\S)(.+?)(?<=\S)\*", re.S)
+    _strong_re = _lazy_re(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
+    _em_re = _lazy_re(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
+    _code_friendly_strong_re = _lazy_re(r"\*\*(?=\S)(.+?[*_]*)(?<=\S)\*\*", re.S)
+    _code_friendly_em_re = _lazy_re(r"\*(?=\S)(.+?)(?<=\S)\*", re.S)
     def _do_italics_and_bold(self, text):
         # <strong> must go first:
         if "code-friendly" in self.extras:
@@ -1606,7 +2047,7 @@ class Markdown(object):
     # apostrophe; e.g. ignores the fact that "round", "bout", "twer", and
     # "twixt" can be written without an initial apostrophe. This is fine because
     # using scare quotes (single quotation marks) is rare.
-    _apostrophe_year_re = re.compile(r"'(\d\d)(?=(\s|,|;|\.|\?|!|$))")
+    _apostrophe_year_re = _lazy_re(r"'(\d\d)(?=(\s|,|;|\.|\?|!|$))")
     _contractions = ["tis", "twas", "twer", "neath", "o", "n",
         "round", "bout", "twixt", "nuff", "fraid", "sup"]
     def _do_smart_contractions(self, text):
@@ -1618,10 +2059,10 @@ class Markdown(object):
         return text
 
     # Substitute double-quotes before single-quotes.
-    _opening_single_quote_re = re.compile(r"(?<!\S)'(?=\S)")
-    _opening_double_quote_re = re.compile(r'(?<!\S)"(?=\S)')
-    _closing_single_quote_re = re.compile(r"(?<=\S)'")
-    _closing_double_quote_re = re.compile(r'(?<=\S)"(?=(\s|,|;|\.|\?|!|$))')
+    _opening_single_quote_re = _lazy_re(r"(?<!\S)'(?=\S)")
+    _opening_double_quote_re = _lazy_re(r'(?<!\S)"(?=\S)')
+    _closing_single_quote_re = _lazy_re(r"(?<=\S)'")
+    _closing_double_quote_re = _lazy_re(r'(?<=\S)"(?=(\s|,|;|\.|\?|!|$))')
     def _do_smart_punctuation(self, text):
         """Fancifies 'single quotes', "double quotes", and apostrophes.
         Converts --, ---, and ... into en dashes, em dashes, and ellipses.
@@ -1648,7 +2089,7 @@ class Markdown(object):
         text = text.replace(". . .", "&#8230;")
         return text
 
-    _block_quote_re = re.compile(r'''
+    _block_quote_re = _lazy_re(r'''
         (                           # Wrap whole match in \1
           (
             ^[ \t]*>[ \t]?          # '>' at the start of a line
@@ -1658,9 +2099,9 @@ class Markdown(object):
           )+
         )
         ''', re.M | re.X)
-    _bq_one_level_re = re.compile('^[ \t]*>[ \t]?', re.M);
+    _bq_one_level_re = _lazy_re('^[ \t]*>[ \t]?', re.M);
 
-    _html_pre_block_re = re.compile(r'(\s*<pre>.+?</pre>)', re.S)
+    _html_pre_block_re = _lazy_re(r'(\s*<pre>.+?</pre>)', re.S)
     def _dedent_two_spaces_sub(self, match):
         return re.sub(r'(?m)^  ', '', match.group(1))
 
@@ -1748,35 +2189,34 @@ class Markdown(object):
 
     # Ampersand-encoding based entirely on Nat Irons's Amputator MT plugin:
     #   http://bumppo.net/projects/amputator/
-    _ampersand_re = re.compile(r'&(?!#?[xX]?(?:[0-9a-fA-F]+|\w+);)')
-    _naked_lt_re = re.compile(r'<(?![a-z/?\$!])', re.I)
-    _naked_gt_re = re.compile(r'''(?<![a-z0-9?!/'"-])>''', re.I)
+    _amps_and_angles_re = _lazy_re(r'''
+          &(?!\#?[xX]?(?:[0-9a-fA-F]+|\w+);)  # '&' that isn't an entity
+        |
+          <(?![a-z/?\$!])                     # naked '<'
+        |
+          (?<![a-z0-9?!/'"-])>                # naked '>'
+        ''', re.I | re.X)
 
     def _encode_amps_and_angles(self, text):
         # Smart processing for ampersands and angle brackets that need
-        # to be encoded.
-        text = self._ampersand_re.sub('&amp;', text)
-
-        # Encode naked <'s
-        text = self._naked_lt_re.sub('&lt;', text)
-
-        # Encode naked >'s
+        # to be encoded: ampersands that don't start an entity, and naked
+        # <'s and >'s, in one pass.
         # Note: Other markdown implementations (e.g. Markdown.pl, PHP
-        # Markdown) don't do this.
-        text = self._naked_gt_re.sub('&gt;', text)
-        return text
+        # Markdown) don't encode naked >'s.
+        return self._amps_and_angles_re.sub(_xml_escape_char_sub, text)
 
     def _encode_backslash_escapes(self, text):
-        for ch, escape in list(self._escape_table.items()):
-            text = text.replace("\\"+ch, escape)
-        return text
+        return self._backslash_escape_re.sub(self._backslash_escape_sub, text)
+
+    def _backslash_escape_sub(self, match):
+        return self._escape_table[match.group(1)]
 
-    _auto_link_re = re.compile(r'<((https?|ftp):[^\'">\s]+)>', re.I)
+    _auto_link_re = _lazy_re(r'<((https?|ftp):[^\'">\s]+)>', re.I)
     def _auto_link_sub(self, match):
         g1 = match.group(1)
         return '<a href="%s">%s</a>' % (g1, g1)
 
-    _auto_email_link_re = re.compile(r"""
+    _auto_email_link_re = _lazy_re(r"""
           <
            (?:mailto:)?
           (
@@ -1839,7 +2279,7 @@ class Markdown(object):
                         .replace('*', self._escape_table['*'])
                         .replace('_', self._escape_table['_']))
                 link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
+                hash = self._hash_text(link)
                 link_from_hash[hash] = link
                 text = text[:start] + hash + text[end:]
         for hash, link in list(link_from_hash.items()):
@@ -1847,10 +2287,18 @@ class Markdown(object):
         return text
 
     def _unescape_special_chars(self, text):
-        # Swap back in all the special characters we've hidden.
-        for ch, hash in list(self._escape_table.items()):
-            text = text.replace(hash, ch)
-        return text
+        # Swap back in all the special characters and code we've hidden.
+        if self._placeholder_prefix not in text: # guard for perf
+            return text
+        return self._placeholder_re.sub(self._unescape_sub, text)
+
+    def _unescape_sub(self, match):
+        hash = match.group(0)
+        if hash in self._unescaped_from_placeholder:
+            return self._unescaped_from_placeholder[hash]
+        elif hash in self._code_table:
+            return self._unescape_special_chars(self._code_table[hash])
+        return hash  # e.g. a hashed HTML span in safe mode
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces
@@ -1874,6 +2322,73 @@ class MarkdownWithExtras(Markdown):
 
 #---- internal support functions
 
+def _timed_stage(markdowner, name, method, timer):
+    """Wrap a bound method of `markdowner` to add its calls and own time
+    to `markdowner.timings[name]` (see `Markdown.record_timings()`).
+    """
+    def timed(*args, **kwargs):
+        timings = markdowner.timings
+        if timings is None:
+            return method(*args, **kwargs)
+        # The time of the stages called by this one, to take off its own.
+        stack = markdowner._timing_stack
+        stack.append(0.0)
+        start = timer()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed = timer() - start
+            inner = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            counts = timings.get(name)
+            if counts is None:
+                counts = timings[name] = [0, 0.0]
+            counts[0] += 1
+            counts[1] += elapsed - inner
+    return timed
+
+def _convert_doc(markdowner, doc, encoding=None):
+    """Convert a `convert_many()` doc: a path to read with the given
+    encoding, or the markdown text if `encoding` is None.
+    """
+    if encoding is not None:
+        fp = codecs.open(doc, 'r', encoding)
+        try:
+            doc = fp.read()
+        finally:
+            fp.close()
+    return markdowner.convert(doc)
+
+# The `Markdown` instance of a `convert_many()` worker process.
+_worker_markdowner = None
+
+def _init_convert_worker(options):
+    global _worker_markdowner
+    _worker_markdowner = Markdown(**options)
+
+def _convert_in_worker(args):
+    doc, encoding = args
+    return _convert_doc(_worker_markdowner, doc, encoding)
+
+def _init_chunk_worker(markdowner):
+    global _worker_markdowner
+    _worker_markdowner = markdowner
+
+def _convert_chunk_in_worker(args):
+    text, comments = args
+    return _worker_markdowner._convert_chunk(text, comments)
+
+def _drain_results(results):
+    """Consume and drop the remaining results of a `Pool.imap()`."""
+    while True:
+        try:
+            next(results)
+        except StopIteration:
+            break
+        except Exception:
+            pass
+
 class UnicodeWithAttrs(unicode):
     """A subclass of unicode used for the return value of conversion to
     possibly attach some attributes. E.g. the "toc_html" attribute when
@@ -1916,8 +2431,8 @@ class UnicodeWithAttrs(unicode):
     toc_html = property(toc_html)
 
 ## {{{ http://code.activestate.com/recipes/577257/ (r1)
-_slugify_strip_re = re.compile(r'[^\w\s-]')
-_slugify_hyphenate_re = re.compile(r'[-\s]+')
+_slugify_strip_re = _lazy_re(r'[^\w\s-]')
+_slugify_hyphenate_re = _lazy_re(r'[-\s]+')
 def _slugify(value):
     """
     Normalizes string, converts to lowercase, removes non-alpha characters,
@@ -1932,6 +2447,18 @@ def _slugify(value):
 ## end of http://code.activestate.com/recipes/577257/ }}}
 
 
+_brackets_re = _lazy_re(r'[\[\]]')
+def _closing_bracket_from_idx(text):
+    """Map the index of each '[' in `text` to that of its matching ']'."""
+    closing_bracket_from_idx = {}
+    open_idxs = []
+    for match in _brackets_re.finditer(text):
+        if match.group(0) == '[':
+            open_idxs.append(match.start())
+        elif open_idxs:
+            closing_bracket_from_idx[open_idxs.pop()] = match.start()
+    return closing_bracket_from_idx
+
 # From http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/52549
 def _curry(*args, **kwargs):
     function, args = args[0], args[1:]
@@ -2122,6 +2649,115 @@ def _hr_tag_re_from_tab_width(tab_width):
         """ % (tab_width - 1), re.X)
 _hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
 
+def _outdent_re_from_tab_width(tab_width):
+    return re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+_outdent_re_from_tab_width = _memoized(_outdent_re_from_tab_width)
+
+def _link_def_re_from_tab_width(tab_width):
+    # Link defs are in the form:
+    #   [id]: url "optional title"
+    return re.compile(r"""
+        ^[ ]{0,%d}\[(.+)\]: # id = \1
+          [ \t]*
+          \n?               # maybe *one* newline
+          [ \t]*
+        <?(.+?)>?           # url = \2
+          [ \t]*
+        (?:
+            \n?             # maybe one newline
+            [ \t]*
+            (?<=\s)         # lookbehind for whitespace
+            ['"(]
+            ([^\n]*)        # title = \3
+            ['")]
+            [ \t]*
+        )?  # title is optional
+        (?:\n+|\Z)
+        """ % (tab_width - 1), re.X | re.M | re.U)
+_link_def_re_from_tab_width = _memoized(_link_def_re_from_tab_width)
+
+def _footnote_def_re_from_tab_width(tab_width):
+    return re.compile(r'''
+        ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
+        [ \t]*
+        (                       # footnote text = \2
+          # First line need not start with the spaces.
+          (?:\s*.*\n+)
+          (?:
+            (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
+            .*\n+
+          )*
+        )
+        # Lookahead for non-space at line-start, or end of doc.
+        (?:(?=^[ ]{0,%d}\S)|\Z)
+        ''' % (tab_width - 1, tab_width, tab_width),
+        re.X | re.M)
+_footnote_def_re_from_tab_width = _memoized(_footnote_def_re_from_tab_width)
+
+def _pyshell_block_re_from_tab_width(tab_width):
+    return re.compile(r"""
+        ^([ ]{0,%d})>>>[ ].*\n   # first line
+        ^(\1.*\S+.*\n)*         # any number of subsequent lines
+        ^\n                     # ends with a blank line
+        """ % (tab_width - 1), re.M | re.X)
+_pyshell_block_re_from_tab_width = _memoized(_pyshell_block_re_from_tab_width)
+
+def _wiki_table_re_from_tab_width(tab_width):
+    return re.compile(r'''
+        (?:(?<=\n\n)|\A\n?)            # leading blank line
+        ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
+        (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
+        ''' % (tab_width - 1), re.M | re.X)
+_wiki_table_re_from_tab_width = _memoized(_wiki_table_re_from_tab_width)
+
+def _list_re_from_tab_width(tab_width, marker_pat, sub_list):
+    whole_list = r'''
+        (                   # \1 = whole list
+          (                 # \2
+            [ ]{0,%d}
+            (%s)            # \3 = first list item marker
+            [ \t]+
+            (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+          )
+          (?:.+?)
+          (                 # \4
+              \Z
+            |
+              \n{2,}
+              (?=\S)
+              (?!           # Negative lookahead for another list item marker
+                [ \t]*
+                %s[ \t]+
+              )
+          )
+        )
+    ''' % (tab_width - 1, marker_pat, marker_pat)
+    if sub_list:
+        return re.compile("^"+whole_list, re.X | re.M | re.S)
+    else:
+        return re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
+                          re.X | re.M | re.S)
+_list_re_from_tab_width = _memoized(_list_re_from_tab_width)
+
+def _code_block_re_from_tab_width(tab_width):
+    return re.compile(r'''
+        (?:\n\n|\A\n?)
+        (               # $1 = the code block -- one or more lines, starting with a space/tab
+          (?:
+            (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
+            .*\n+
+          )+
+        )
+        ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
+        ''' % (tab_width, tab_width),
+        re.M | re.X)
+_code_block_re_from_tab_width = _memoized(_code_block_re_from_tab_width)
+
+
+_xml_special_chars_re = _lazy_re('[&<>]')
+_xml_escape_from_char = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+def _xml_escape_char_sub(match):
+    return _xml_escape_from_char[match.group(0)]
 
 def _xml_escape_attr(attr, skip_single_quote=True):
     """Escape the given string for use in an HTML/XML tag attribute.
@@ -2143,8 +2779,9 @@ def _xml_encode_email_char_at_random(ch):
     r = random()
     # Roughly 10% raw, 45% hex, 45% dec.
     # '@' *must* be encoded. I [John Gruber] insist.
-    # Issue 26: '_' must be encoded.
-    if r > 0.9 and ch not in "@_":
+    # Issue 26: '_' must be encoded. So must '*', else a pair of them in
+    # the address is later taken for emphasis.
+    if r > 0.9 and ch not in "@_*":
         return ch
     elif r < 0.45:
         # The [1:] is to drop leading '0': 0x63 -> x63
@@ -2156,16 +2793,18 @@ def _xml_encode_email_char_at_random(ch):
 
 #---- mainline
 
-class _NoReflowFormatter(optparse.IndentedHelpFormatter):
-    """An optparse formatter that does NOT reflow the description."""
-    def format_description(self, description):
-        return description or ""
-
 def _test():
     import doctest
     doctest.testmod()
 
 def main(argv=None):
+    import optparse
+
+    class _NoReflowFormatter(optparse.IndentedHelpFormatter):
+        """An optparse formatter that does NOT reflow the description."""
+        def format_description(self, description):
+            return description or ""
+
     if argv is None:
         argv = sys.argv
     if not logging.root.handlers:
@@ -2196,6 +2835,12 @@ def main(argv=None):
                            "<https://github.com/trentm/python-markdown2/wiki/Extras>")
     parser.add_option("--link-patterns-file",
                       help="path to a link pattern file")
+    parser.add_option("-j", "--jobs", type="int",
+                      help="convert each document in chunks over this many "
+                           "worker processes (for large documents)")
+    parser.add_option("--timings", action="store_true",
+                      help="print the number of calls to and time spent in "
+                           "each conversion stage (to stderr)")
     parser.add_option("--self-test", action="store_true",
                       help="run internal self-tests (some doctests)")
     parser.add_option("--compare", action="store_true",
@@ -2249,6 +2894,9 @@ def main(argv=None):
                        "Markdown.pl")
     if not paths:
         paths = ['-']
+    timings = None
+    if opts.timings:
+        timings = {}
     for path in paths:
         if path == '-':
             text = sys.stdin.read()
@@ -2269,11 +2917,16 @@ def main(argv=None):
                 sys.stdout.write(perl_html.encode(
                     sys.stdout.encoding or "utf-8", 'xmlcharrefreplace'))
             print("==== markdown2.py ====")
-        html = markdown(text,
-            html4tags=opts.html4tags,
+        markdowner = Markdown(html4tags=opts.html4tags,
             safe_mode=opts.safe_mode,
             extras=extras, link_patterns=link_patterns,
             use_file_vars=opts.use_file_vars)
+        if timings is not None:
+            markdowner.record_timings(timings)
+        if opts.jobs:
+            html = markdowner.convert_parallel(text, jobs=opts.jobs)
+        else:
+            html = markdowner.convert(text)
         if py3:
             sys.stdout.write(html)
         else:
@@ -2293,6 +2946,8 @@ def main(argv=None):
                 norm_html = html
                 norm_perl_html = perl_html
             print("==== match? %r ====" % (norm_perl_html == norm_html))
+    if timings is not None:
+        sys.stderr.write(format_timings(timings) + "\n")
 
 
 if __name__ == "__main__":
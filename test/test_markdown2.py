@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Regression tests for nodedoc's changes to deps/markdown2.py."""
+
+import codecs
+import os
+import re
+import sys
+import unittest
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(TOP, "deps"))
+import markdown2
+
+
+def _decode_char_refs(html):
+    def sub(match):
+        ref = match.group(1)
+        if ref[0] in "xX":
+            return unichr(int(ref[1:], 16))
+        return unichr(int(ref))
+    return re.sub(r"&#(x[0-9a-fA-F]+|\d+);", sub, html)
+
+if sys.version_info[0] >= 3:
+    unichr = chr
+
+
+class PlaceholderTestCase(unittest.TestCase):
+    def _assert_mailto(self, text, addr):
+        html = markdown2.markdown(text)
+        self.assertTrue('<a href="' in html, html)
+        self.assertFalse(addr in html, html)  # the address is entity-encoded
+        self.assertEqual(_decode_char_refs(html).count(addr),
+            2, html)
+
+    def test_email_auto_link_with_underscore(self):
+        self._assert_mailto(u"Mail <foo_bar@example.com> now.\n",
+            u"foo_bar@example.com")
+
+    def test_email_auto_link_with_star(self):
+        self._assert_mailto(u"<a*b@example.com>\n", u"a*b@example.com")
+
+    def test_prefix_not_in_text(self):
+        md = markdown2.Markdown()
+        html = md.convert(u"xmdq0x mdqq1x `code` \\*\n")
+        self.assertEqual(md._placeholder_prefix, u"xmdqqq")
+        self.assertEqual(html,
+            u"<p>xmdq0x mdqq1x <code>code</code> *</p>\n")
+
+    def test_placeholders_are_ascii_words(self):
+        # So that they match `\w` runs, and any that leak into the output
+        # are harmless.
+        md = markdown2.Markdown()
+        md.convert(u"<b>x</b> `c` \\*\n")
+        for placeholder in md._placeholder_from_text.values():
+            self.assertTrue(re.match(r"[a-z0-9]+$", placeholder),
+                repr(placeholder))
+
+
+class ListTestCase(unittest.TestCase):
+    def test_nested_empty_list_items(self):
+        self.assertEqual(markdown2.markdown(u"* - \n* b\n"),
+            u"<ul>\n<li><ul>\n<li></li>\n</ul></li>\n<li>b</li>\n</ul>\n")
+        self.assertEqual(markdown2.markdown(u"1. a\n    - \n"),
+            u"<ol>\n<li>a\n<ul>\n<li></li>\n</ul></li>\n</ol>\n")
+
+    def test_empty_list_item(self):
+        self.assertEqual(markdown2.markdown(u"+ \n"),
+            u"<ul>\n<li></li>\n</ul>\n")
+
+
+class _LeakyMarkdown(markdown2.Markdown):
+    # Leaves all placeholders in its output.
+    def _unescape_special_chars(self, text):
+        return text
+
+
+class ParallelTestCase(unittest.TestCase):
+    sections = ["events", "path", "zlib", "net", "fs"]
+
+    def _assert_same_as_convert(self, md, text):
+        md._min_chunk_size = 1024
+        self.assertTrue(len(md._split_chunks(md._prepare(text), 8)) > 2)
+        self.assertEqual(md.convert_parallel(text, jobs=2), md.convert(text))
+
+    def _api_doc(self):
+        texts = []
+        for section in self.sections:
+            path = os.path.join(TOP, "doc", "api10", section + ".markdown")
+            texts.append(codecs.open(path, "r", "utf-8").read())
+        return u"\n\n".join(texts)
+
+    def test_same_as_convert(self):
+        self._assert_same_as_convert(markdown2.Markdown(), self._api_doc())
+
+    def test_placeholders_left_in_output(self):
+        # Placeholders made while converting a chunk are numbered in its
+        # worker, not as `convert()` numbers them.
+        text = u"\n\n".join(u"# s%d\n\nSee `f%d()` and \\*%s.\n"
+            % (i, i, u"x" * 1000) for i in range(8))
+        self._assert_same_as_convert(_LeakyMarkdown(), text)
+
+
+if __name__ == "__main__":
+    unittest.main()
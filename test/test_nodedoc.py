@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for bin/nodedoc.py."""
+
+import codecs
+import os
+from os.path import abspath, dirname, join
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+if sys.version_info[0] >= 3:
+    raise unittest.SkipTest("nodedoc.py is Python 2 only")
+
+TOP = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(TOP, "bin"))
+sys.path.insert(0, join(TOP, "tools"))
+import nodedoc
+import mkcorpus
+import markdown2
+
+_sgr_re = re.compile(r"\033\[\d+m")
+
+def _visible_lines(text):
+    return _sgr_re.sub("", text).split("\n")
+
+
+class RenderTestCase(unittest.TestCase):
+    def _render_section(self, v, section):
+        path = join(TOP, "doc", "api" + v, section + ".markdown")
+        html = markdown2.markdown(codecs.open(path, 'r', 'utf-8').read())
+        return nodedoc.render_nodedoc(html)
+
+    def test_zlib_links(self):
+        # Auto-links in paragraphs used to be reflowed as raw HTML, so that
+        # their tags were broken over lines and left in the output.
+        for v in ("6", "8", "10"):
+            lines = _visible_lines(self._render_section(v, "zlib"))
+            self.assertTrue("http://zlib.net/manual.html#Advanced for more "
+                "information on these." in lines)
+            for line in lines:
+                self.assertFalse("<a" in line or "</a" in line, line)
+                # Only code blocks and headers aren't reflowed.
+                if not line.startswith(("    ", "#")):
+                    self.assertTrue(len(line) <= 80, line)
+
+    def test_nested_lists(self):
+        html = ("<ul>\n<li>one</li>\n<li>two\n<ol>\n<li>two.a</li>\n"
+            "<li>two.b</li>\n</ol></li>\n<li>three</li>\n</ul>\n")
+        self.assertEqual(nodedoc.render_nodedoc(html),
+            "\n- one\n- two\n  1. two.a\n  2. two.b\n- three\n")
+
+    def test_ol_numbering(self):
+        html = ("<ol>\n<li>first</li>\n<li>second\n<ol>\n<li>nested</li>\n"
+            "<li>nested two</li>\n</ol></li>\n<li>third</li>\n</ol>\n")
+        self.assertEqual(nodedoc.render_nodedoc(html),
+            "\n1. first\n2. second\n   1. nested\n   2. nested two\n"
+            "3. third\n")
+
+    def test_multi_paragraph_list_item(self):
+        html = ("<ul>\n<li><p>para one</p>\n\n<p>para two</p></li>\n"
+            "<li><p>next</p></li>\n</ul>\n")
+        self.assertEqual(nodedoc.render_nodedoc(html),
+            "\n- para one\n\n  para two\n- next\n")
+
+    def test_list_item_reflow(self):
+        html = "<ul>\n<li>aaa bbb ccc ddd</li>\n</ul>\n"
+        self.assertEqual(nodedoc.render_nodedoc(html, width=11),
+            "\n- aaa bbb\n  ccc ddd\n")
+
+    def test_pre(self):
+        html = ("<p>Code:</p>\n\n<pre><code>var a = 1 &lt; 2 &amp;&amp; b;\n"
+            "  f();\n</code></pre>\n\n"
+            "<pre><code>Stability: 3 - Stable\n</code></pre>\n")
+        self.assertEqual(nodedoc.render_nodedoc(html),
+            "Code:\n\n"
+            "    " + nodedoc.green("var a = 1 < 2 && b;") + "\n"
+            "    " + nodedoc.green("  f();") + "\n\n"
+            "    " + nodedoc.grey("Stability: 3 - Stable") + "\n")
+
+    def test_headers(self):
+        html = ("<h1>Title</h1>\n\n<h2>fs.chown(path, [callback])</h2>\n\n"
+            "<h3>Event: <code>'close'</code></h3>\n")
+        self.assertEqual(nodedoc.render_nodedoc(html),
+            nodedoc.bold(nodedoc.red("# Title")) + "\n\n\n"
+            + nodedoc.bold(nodedoc.red("## fs.chown(path, [callback])"))
+            + "\n\n\n" + nodedoc.bold(nodedoc.red(
+                "### Event: " + nodedoc.green("'close'"))) + "\n")
+
+    def test_inline(self):
+        html = ('<p>Use <code>fs.stat()</code> or <code>&lt;a&gt;</code>, '
+            'see <a href="http://x.com">the link</a>, <em>em</em> and '
+            '<strong>strong</strong>. 1 &lt; 2.</p>\n')
+        self.assertEqual(nodedoc.render_nodedoc(html),
+            "Use " + nodedoc.green("fs.stat()") + " or "
+            + nodedoc.green("<a>") + ", see " + "\033[34mthe link\033[39m"
+            + ", " + nodedoc.cyan("*") + nodedoc.cyan("em") + nodedoc.cyan("*")
+            + " and " + nodedoc.bold(nodedoc.cyan("**"))
+            + nodedoc.bold(nodedoc.cyan("strong"))
+            + nodedoc.bold(nodedoc.cyan("**")) + ". 1 < 2.\n")
+
+    def test_reflow_by_visible_width(self):
+        html = ('<p>aaa bbb <a href="http://x.com">ccc ddd</a> eee '
+            'fffffffffffff</p>\n')
+        self.assertEqual(nodedoc.render_nodedoc(html, width=11),
+            "aaa bbb \033[34mccc\033[39m\n"
+            "\033[34mddd\033[39m eee\n"
+            "fffffffffff\nff\n")
+
+
+class ParseRequestTestCase(unittest.TestCase):
+    def _assert_invalid(self, line, message):
+        # Not `except ..., ex`: Python 3 must be able to parse this module
+        # to skip it.
+        with self.assertRaises(nodedoc.Error) as cm:
+            nodedoc._parse_request(line)
+        self.assertEqual(str(cm.exception), message)
+
+    def test_valid(self):
+        request = nodedoc._parse_request('{"version": "%s", "section": "fs",'
+            ' "term": null}\n' % nodedoc.__version__)
+        self.assertEqual(request["section"], u"fs")
+
+    def test_invalid(self):
+        version = '"version": "%s"' % nodedoc.__version__
+        self._assert_invalid("[]\n", "invalid request: not a JSON object")
+        self._assert_invalid('"x"\n', "invalid request: not a JSON object")
+        self._assert_invalid('{"version": "0.0.0", "section": "fs"}',
+            "client version 0.0.0 does not match daemon version %s"
+            % nodedoc.__version__)
+        self._assert_invalid('{%s}' % version,
+            'invalid request: no "section" string')
+        self._assert_invalid('{%s, "section": "fs", "term": 1}' % version,
+            'invalid request: "term" is not a string')
+        self._assert_invalid('{%s, "section": "fs", "v": null}' % version,
+            'invalid request: "v" is not a string')
+        self.assertRaises(nodedoc.Error, nodedoc._parse_request, "{bad\n")
+
+
+class HeaderPostingsTestCase(unittest.TestCase):
+    """Check that searching a header index via its postings, as
+    `nodedoc --serve` does, gives the same hits as scanning it.
+
+    The header index searched is the source header index (as for
+    $NODEDOC_LAZY) of a synthetic tree the size of doc/api10, which doesn't
+    need the sections rendered. (`make bench-large` runs the same search
+    over much larger trees.)
+    """
+    v = "corpus"
+    terms = ["chown", "fs.chown", "createServer", "readFile", "stat",
+        "Stat", "write", "Sync", "Server", "Event: 'close'", "on", "e",
+        "callback", "nosuchapi", "\xc3\xa9"]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp(prefix="nodedoc-test-")
+        mkcorpus.make_corpus(join(cls.tmp_dir, "doc", "api" + cls.v))
+        cls.saved = (nodedoc.TOP, nodedoc.CACHE_DIR, nodedoc.PREBUILT_DIR,
+            os.environ.get("NODEDOC_LAZY"))
+        nodedoc.TOP = cls.tmp_dir
+        nodedoc.CACHE_DIR = join(cls.tmp_dir, "cache")
+        nodedoc.PREBUILT_DIR = join(cls.tmp_dir, "prebuilt")
+        os.environ["NODEDOC_LAZY"] = "1"
+
+    @classmethod
+    def tearDownClass(cls):
+        (nodedoc.TOP, nodedoc.CACHE_DIR, nodedoc.PREBUILT_DIR,
+            lazy) = cls.saved
+        if lazy is None:
+            del os.environ["NODEDOC_LAZY"]
+        else:
+            os.environ["NODEDOC_LAZY"] = lazy
+        nodedoc._use_postings = False
+        nodedoc._cache_dirs.clear()
+        nodedoc._source_index_cache.clear()
+        nodedoc._header_postings_cache.clear()
+        shutil.rmtree(cls.tmp_dir)
+
+    def _resolve(self, term, use_postings):
+        nodedoc._use_postings = use_postings
+        try:
+            result = nodedoc.resolve(term, want_list=True, v=self.v)
+        except nodedoc.Error:
+            return []
+        self.assertEqual(result["action"], "list")
+        return [(h["section"], h["ordinal"]) for h in result["hits"]]
+
+    def test_resolve(self):
+        found = 0
+        for term in self.terms:
+            hits = self._resolve(term, False)
+            self.assertEqual(self._resolve(term, True), hits, term)
+            found += bool(hits)
+        self.assertTrue(found > len(self.terms) / 2)
+
+    def test_exact_hits(self):
+        index = nodedoc.ensure_source_index(self.v)
+        self.assertTrue(len(index["headers"]) > 500)
+        postings = nodedoc.header_postings(index)
+        for term in self.terms:
+            term = nodedoc._decode_term(term)
+            scanned = list(nodedoc.search_header_index(index, term))
+            hits = list(nodedoc.search_header_index(index, term, postings))
+            self.assertEqual([h["id"] for h in hits],
+                [h["id"] for h in scanned], term)
+            self.assertEqual(
+                [h["id"] for h in nodedoc.exact_hits(hits, term, postings)],
+                [h["id"] for h in nodedoc.exact_hits(scanned, term)], term)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""bench -- benchmark nodedoc over the bundled doc trees
+
+Measures, for each of doc/api6, doc/api8 and doc/api10 (or the given
+`--tree`s and `--corpus` dirs):
+
+- convert: markdown2 conversion of all the sections (one converter);
+- render: rendering all the sections' HTML to ANSI text;
+- build-cold: `ensure_nodedocs_built()` with an empty cache dir;
+- build-warm: `ensure_nodedocs_built()` with an up to date cache;
+- index-load: `ensure_header_index()` with an up to date cache;
+- search: looking up a fixed set of terms in the loaded header index.
+
+Each run of a benchmark is a fresh Python process with its own cache dir,
+which also gives the peak memory (max RSS) of each. The best time over
+the runs is kept. Results are written as JSON and can be compared with
+those of an earlier (baseline) run, in which case this fails if any time
+or peak memory got worse by more than the tolerance.
+
+A `--corpus DIR` is a dir of "<section>.markdown" files, e.g. a large
+synthetic one from "tools/mkcorpus.py", benchmarked as if it were a doc
+tree. Its results are keyed by the dir's name.
+
+Usage:
+    ./tools/bench.py [-n RUNS] [-o RESULTS] [-b BASELINE] [--corpus DIR]
+"""
+
+import sys
+import os
+from os.path import dirname, join, abspath, exists, basename, isdir
+import json
+import optparse
+import shutil
+import subprocess
+import tempfile
+import time
+from glob import glob
+
+
+#---- globals and config
+
+TOP = dirname(dirname(abspath(__file__)))
+TREES = ["6", "8", "10"]
+
+# Terms looked up by the "search" benchmark: exact API names, substrings,
+# short terms (which scan all headers) and a miss.
+QUERIES = ["chown", "fs.stat", "spawn", "createServer", "readFile", "write",
+    "Buffer", "setTimeout", "on", "end", "nosuchapi"]
+
+class Error(Exception):
+    pass
+
+
+
+#---- benchmarks (each run in a child process, see `_run_child()`)
+
+def _markdown_datas(nodedoc, v):
+    datas = []
+    for path in sorted(nodedoc.markdown_paths_from_v(v)):
+        f = open(path, 'rb')
+        try:
+            datas.append(f.read())
+        finally:
+            f.close()
+    return datas
+
+def bench_convert(nodedoc, v):
+    import markdown2
+    datas = _markdown_datas(nodedoc, v)
+    texts = [data.decode('utf-8') for data in datas]
+    markdowner = markdown2.Markdown()
+    # Warm up (markdown2 compiles its regexes on first use), so this
+    # measures throughput. The first use is part of "build-cold".
+    for text in texts:
+        markdowner.convert(text)
+    start = time.time()
+    for text in texts:
+        markdowner.convert(text)
+    return {"seconds": time.time() - start,
+        "bytes": sum([len(data) for data in datas])}
+
+def bench_render(nodedoc, v):
+    import markdown2
+    markdowner = markdown2.Markdown()
+    htmls = [markdowner.convert(data.decode('utf-8'))
+        for data in _markdown_datas(nodedoc, v)]
+    for html in htmls:
+        nodedoc.render_nodedoc(html)    # warm up, as for "convert"
+    start = time.time()
+    for html in htmls:
+        nodedoc.render_nodedoc(html)
+    return {"seconds": time.time() - start,
+        "bytes": sum([len(html.encode('utf-8')) for html in htmls])}
+
+def _time_per_call(func, batches=5, min_seconds=0.02):
+    """Return the time per call of `func`, for benchmarks too quick to
+    time once: the best over `batches` of calls that each take at least
+    `min_seconds`.
+    """
+    best = None
+    for i in range(batches):
+        calls = 0
+        start = time.time()
+        while True:
+            func()
+            calls += 1
+            elapsed = time.time() - start
+            if elapsed >= min_seconds:
+                break
+        if best is None or elapsed / calls < best:
+            best = elapsed / calls
+    return best
+
+def bench_build_cold(nodedoc, v):
+    start = time.time()
+    nodedoc.ensure_nodedocs_built(v=v, jobs=1)
+    return {"seconds": time.time() - start}
+
+def bench_build_warm(nodedoc, v):
+    return {"seconds": _time_per_call(
+        lambda: nodedoc.ensure_nodedocs_built(v=v, jobs=1))}
+
+def bench_index_load(nodedoc, v):
+    start = time.time()
+    nodedoc.ensure_header_index(v=v, jobs=1)
+    return {"seconds": time.time() - start}
+
+def bench_search(nodedoc, v):
+    index = nodedoc.ensure_header_index(v=v, jobs=1)
+    def search():
+        for term in QUERIES:
+            hits = list(nodedoc.search_header_index(index, term))
+            nodedoc.exact_hits(hits, term)
+    return {"seconds": _time_per_call(search), "queries": len(QUERIES)}
+
+# Benchmarks: name, function and whether it needs a warm cache.
+BENCHMARKS = [
+    ("convert", bench_convert, False),
+    ("render", bench_render, False),
+    ("build-cold", bench_build_cold, False),
+    ("build-warm", bench_build_warm, True),
+    ("index-load", bench_index_load, True),
+    ("search", bench_search, True),
+]
+
+def _run_child(name, v, top):
+    """Run one benchmark (in this process) and print its result.
+
+    @param top {str} The dir with the "doc/api<v>" tree to use (see
+        `_corpus_tree()`).
+    """
+    import resource
+    sys.path.insert(0, join(TOP, "bin"))
+    import nodedoc
+    nodedoc.TOP = top
+    # Benchmark the user cache dir, not a prebuilt one from
+    # `make prebuild`.
+    nodedoc.PREBUILT_DIR = join(nodedoc.CACHE_DIR, "no-prebuilt")
+    func = dict([(n, f) for n, f, warm in BENCHMARKS])[name]
+    result = func(nodedoc, v)
+    result["max_rss_kb"] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss
+    print json.dumps(result)
+
+
+
+#---- main functionality
+
+def _corpus_tree(corpus_dir, tmp_dirs):
+    """Set up a dir of markdown files to benchmark as a doc tree.
+
+    nodedoc finds the sections of doc tree `v` in "<TOP>/doc/api<v>", so
+    this links the dir in as "doc/apicorpus" under a new temp dir (added
+    to `tmp_dirs`) to use as TOP.
+
+    @returns {tuple} The tree: (<label>, <v>, <top>).
+    """
+    if not isdir(corpus_dir):
+        raise Error("'%s' is not a dir" % corpus_dir)
+    if not glob(join(corpus_dir, "*.markdown")):
+        raise Error("no *.markdown files in '%s'" % corpus_dir)
+    top = tempfile.mkdtemp(prefix="nodedoc-bench-")
+    tmp_dirs.append(top)
+    os.mkdir(join(top, "doc"))
+    os.symlink(abspath(corpus_dir), join(top, "doc", "apicorpus"))
+    return (basename(abspath(corpus_dir)), "corpus", top)
+
+def _child_result(name, v, top, cache_home):
+    env = dict(os.environ)
+    env["XDG_CACHE_HOME"] = cache_home
+    env.pop("NODEDOC_PACK", None)
+    env.pop("NODEDOC_LAZY", None)
+    env.pop("NODEDOC_PROFILE", None)
+    p = subprocess.Popen([sys.executable, abspath(__file__), "--child",
+        name, v, top], env=env, stdout=subprocess.PIPE)
+    output = p.communicate()[0]
+    if p.returncode:
+        raise Error("benchmark %s for api%s failed" % (name, v))
+    return json.loads(output.splitlines()[-1])
+
+def _best(runs):
+    """The best of the results of several runs of a benchmark."""
+    result = dict(runs[0])
+    result["seconds"] = min([r["seconds"] for r in runs])
+    result["max_rss_kb"] = max([r["max_rss_kb"] for r in runs])
+    if "bytes" in result:
+        result["mb_per_s"] = result["bytes"] / result["seconds"] / 1e6
+    if "queries" in result:
+        result["ms_per_query"] = (result["seconds"] * 1000.0
+            / result["queries"])
+    return result
+
+def _format_result(key, result):
+    s = "%-28s %9.1fms %8dKB" % (key, result["seconds"] * 1000.0,
+        result["max_rss_kb"])
+    if "mb_per_s" in result:
+        s += " %7.2fMB/s" % result["mb_per_s"]
+    if "ms_per_query" in result:
+        s += " %7.3fms/query" % result["ms_per_query"]
+    return s
+
+def run_benchmarks(trees=None, names=None, runs=5):
+    """Run the benchmarks and return their results.
+
+    @param trees {list} The doc trees to benchmark, each a tuple of
+        (<label>, <v>, <top>). By default the bundled doc trees.
+    @returns {dict} The best result of each benchmark for each doc tree,
+        keyed by "<benchmark>:<label>", e.g. "search:api10".
+    """
+    if trees is None:
+        trees = [("api" + v, v, TOP) for v in TREES]
+    results = {}
+    for label, v, top in trees:
+        # Cold cache dirs, a fresh one for each run.
+        tmp_dirs = []
+        try:
+            warm_home = tempfile.mkdtemp(prefix="nodedoc-bench-")
+            tmp_dirs.append(warm_home)
+            # Warm the cache (including the header index) for the
+            # benchmarks that need it.
+            _child_result("index-load", v, top, warm_home)
+            for name, func, warm in BENCHMARKS:
+                if names and name not in names:
+                    continue
+                runs_results = []
+                for i in range(runs):
+                    if warm:
+                        cache_home = warm_home
+                    else:
+                        cache_home = tempfile.mkdtemp(prefix="nodedoc-bench-")
+                        tmp_dirs.append(cache_home)
+                    runs_results.append(_child_result(name, v, top,
+                        cache_home))
+                key = "%s:%s" % (name, label)
+                results[key] = _best(runs_results)
+                print _format_result(key, results[key])
+        finally:
+            for d in tmp_dirs:
+                shutil.rmtree(d)
+    return results
+
+def compare(results, baseline, tolerance=0.25, memory_tolerance=0.1):
+    """Print how `results` compare with `baseline`.
+
+    @returns {list} The regressions: a description of each time or peak
+        memory that is worse than the baseline's by more than the
+        tolerance (a fraction, e.g. 0.25 for 25%).
+    """
+    regressions = []
+    print "%-28s %-10s %10s %10s %8s" % ("BENCHMARK", "METRIC", "BASELINE",
+        "NOW", "CHANGE")
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        for metric, tol, fmt in (("seconds", tolerance, "%.1fms"),
+                                 ("max_rss_kb", memory_tolerance, "%dKB")):
+            old = baseline[key][metric]
+            new = results[key][metric]
+            change = old and (new - old) / float(old) or 0.0
+            flag = ""
+            if change > tol:
+                flag = "  <-- regression"
+                regressions.append("%s %s: %+.1f%% (over %.0f%%)"
+                    % (key, metric, change * 100.0, tol * 100.0))
+            if metric == "seconds":
+                old_str = fmt % (old * 1000.0)
+                new_str = fmt % (new * 1000.0)
+            else:
+                old_str = fmt % old
+                new_str = fmt % new
+            print "%-28s %-10s %10s %10s %+7.1f%%%s" % (key, metric,
+                old_str, new_str, change * 100.0, flag)
+    return regressions
+
+
+
+#---- mainline
+
+def main(argv):
+    parser = optparse.OptionParser(prog="bench", usage='',
+        description=__doc__)
+    parser.add_option("-n", "--runs", type="int", default=5,
+        help="number of runs to take the best of (default 5)")
+    parser.add_option("-o", "--output", metavar="PATH",
+        help="write the results as JSON to this file")
+    parser.add_option("-b", "--baseline", metavar="PATH",
+        help="compare with the results in this file (skipped if it "
+            "doesn't exist)")
+    parser.add_option("-t", "--tolerance", type="float", default=0.25,
+        help="allowed slowdown over the baseline (default 0.25, i.e. 25%)")
+    parser.add_option("-m", "--memory-tolerance", type="float", default=0.1,
+        help="allowed peak memory growth over the baseline (default 0.1)")
+    parser.add_option("-k", "--benchmark", dest="names", action="append",
+        help="only run this benchmark (can be repeated)")
+    parser.add_option("--tree", dest="trees", action="append",
+        help="only use this doc tree, e.g. '10' (can be repeated)")
+    parser.add_option("--corpus", dest="corpora", metavar="DIR",
+        action="append", help="use this dir of markdown sections as a doc "
+            "tree, e.g. one from tools/mkcorpus.py (can be repeated)")
+    parser.add_option("--child", nargs=3, help=optparse.SUPPRESS_HELP)
+    opts, args = parser.parse_args(argv[1:])
+    if opts.child:
+        return _run_child(*opts.child)
+
+    tmp_dirs = []
+    try:
+        trees = [("api" + v, v, TOP) for v in opts.trees or []]
+        for corpus_dir in opts.corpora or []:
+            trees.append(_corpus_tree(corpus_dir, tmp_dirs))
+        results = run_benchmarks(trees=trees or None, names=opts.names,
+            runs=opts.runs)
+        if opts.output:
+            f = open(opts.output, 'w')
+            try:
+                json.dump({
+                    "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "host": os.uname()[1],
+                    "python": sys.version.split()[0],
+                    "runs": opts.runs,
+                    "results": results,
+                }, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+        if opts.baseline and not exists(opts.baseline):
+            print "no baseline at '%s' to compare with" % opts.baseline
+        elif opts.baseline:
+            f = open(opts.baseline)
+            try:
+                baseline = json.load(f)["results"]
+            finally:
+                f.close()
+            regressions = compare(results, baseline, opts.tolerance,
+                opts.memory_tolerance)
+            if regressions:
+                raise Error("performance regressions:\n  "
+                    + "\n  ".join(regressions))
+    except Error, ex:
+        sys.stderr.write("bench: error: %s\n" % ex)
+        return 1
+    finally:
+        for d in tmp_dirs:
+            shutil.rmtree(d)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""check-startup -- check nodedoc's warm-path startup budget
+
+Runs `bin/nodedoc` for a few common commands against a warm cache and
+checks that none of the modules only needed for building the cache
+(markdown2, multiprocessing) or for option parsing (optparse and the
+textwrap it imports) are imported. That doesn't depend on the machine, so `make check`
+runs it.
+
+With `-t`, it also checks that the best wall time of each command over
+that of a bare `python -c pass` is within budget. The bare interpreter is
+timed in the same loop as the commands, and the best of the runs is taken
+for each, but a slow or busy machine can still fail this.
+
+Usage:
+    ./tools/check-startup.py [-t [-n RUNS] [-s SCALE]]
+"""
+
+import sys
+import os
+from os.path import dirname, join, abspath
+import json
+import optparse
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+#---- globals and config
+
+TOP = dirname(dirname(abspath(__file__)))
+NODEDOC = join(TOP, "bin", "nodedoc")
+
+# Budget (in ms over bare interpreter startup) for each warm command.
+BUDGETS = [
+    (["fs"], 50),               # nodedoc SECTION
+    (["fs", "chown"], 50),      # nodedoc SECTION TERM
+    (["chown"], 100),           # nodedoc TERM (loads the header index)
+]
+
+# Modules that must not be imported on the warm path.
+FORBIDDEN_MODULES = ["markdown2", "textwrap", "optparse", "multiprocessing"]
+
+# Run a nodedoc command in-process and print the modules it imported.
+MODULES_SCRIPT = """
+import sys, json
+sys.path.insert(0, %r)
+import nodedoc
+sys.argv = ["nodedoc"] + %r
+nodedoc.main(sys.argv)
+print json.dumps(sorted(sys.modules))
+"""
+
+class Error(Exception):
+    pass
+
+
+
+#---- main functionality
+
+def _best_ms(argvs, env, runs):
+    """Run each of the given commands `runs` times, interleaved, and
+    return the best wall time (in ms) of each.
+    """
+    best = [None] * len(argvs)
+    devnull = open(os.devnull, 'w')
+    try:
+        for i in range(runs):
+            for j, argv in enumerate(argvs):
+                start = time.time()
+                subprocess.check_call(argv, env=env, stdout=devnull)
+                elapsed = (time.time() - start) * 1000.0
+                if best[j] is None or elapsed < best[j]:
+                    best[j] = elapsed
+    finally:
+        devnull.close()
+    return best
+
+def _check_times(env, runs, scale):
+    argvs = [[sys.executable, "-c", "pass"]]
+    for args, budget in BUDGETS:
+        argvs.append([sys.executable, NODEDOC] + args)
+    times = _best_ms(argvs, env, runs)
+    base = times[0]
+    print "python startup: %.1fms" % base
+    failures = []
+    for (args, budget), ms in zip(BUDGETS, times[1:]):
+        budget *= scale
+        ms -= base
+        print "nodedoc %-12s +%.1fms (budget %.0fms)" % (
+            " ".join(args), ms, budget)
+        if ms > budget:
+            failures.append("`nodedoc %s` took %.1fms over budget"
+                % (" ".join(args), ms - budget))
+    return failures
+
+def check_startup(timed=False, runs=20, scale=1.0):
+    cache_home = tempfile.mkdtemp(prefix="nodedoc-check-startup-")
+    try:
+        env = dict(os.environ)
+        env["XDG_CACHE_HOME"] = cache_home
+        env["PAGER"] = "true"
+        env["NODEDOC_SOCKET"] = join(cache_home, "no-such.sock")
+        # Allow the launcher to cache nodedoc.py's bytecode, as it would
+        # for a user.
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+
+        # Warm the cache.
+        for args, budget in BUDGETS:
+            subprocess.check_call([sys.executable, NODEDOC, "-q"] + args,
+                env=env)
+
+        failures = []
+        for args, budget in BUDGETS:
+            output = subprocess.Popen([sys.executable, "-c",
+                MODULES_SCRIPT % (join(TOP, "bin"), args)], env=env,
+                stdout=subprocess.PIPE).communicate()[0]
+            modules = json.loads(output.splitlines()[-1])
+            for name in FORBIDDEN_MODULES:
+                if name in modules:
+                    failures.append("`nodedoc %s` imported %s"
+                        % (" ".join(args), name))
+
+        if timed:
+            failures += _check_times(env, runs, scale)
+    finally:
+        shutil.rmtree(cache_home)
+
+    if failures:
+        raise Error("startup check failed:\n  " + "\n  ".join(failures))
+
+
+
+#---- mainline
+
+def main(argv):
+    parser = optparse.OptionParser(prog="check-startup", usage='',
+        description=__doc__)
+    parser.add_option("-t", "--time", action="store_true",
+        help="also check the commands' wall times against their budgets")
+    parser.add_option("-n", "--runs", type="int", default=20,
+        help="number of runs to take the best of (default 20)")
+    parser.add_option("-s", "--scale", type="float", default=1.0,
+        help="scale the budgets by this factor, e.g. for slow machines")
+    opts, args = parser.parse_args(argv[1:])
+    try:
+        check_startup(timed=opts.time, runs=opts.runs, scale=opts.scale)
+    except Error, ex:
+        sys.stderr.write("check-startup: error: %s\n" % ex)
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
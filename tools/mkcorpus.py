@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""mkcorpus -- generate a synthetic node.js-doc-like markdown corpus
+
+Writes SECTIONS "<section>.markdown" files to DIR that are shaped like
+the sections in doc/api*: a title and stability note, prose with inline
+code and links, `##` API and class headers with `###` method, event and
+property headers under the classes, indented code examples, lists and
+link definitions. The defaults give a tree about the size of doc/api10
+(36 sections, ~20 API headers each); e.g. use `-n 3600` for one 100 times
+that size. The output is the same for the same options and seed.
+
+Usage:
+    ./tools/mkcorpus.py [-n SECTIONS] [-a APIS] [--seed SEED] DIR
+
+Benchmark the corpus with `./tools/bench.py --corpus DIR`.
+"""
+
+import sys
+import os
+from os.path import exists, join
+import optparse
+import random
+
+
+#---- globals and config
+
+MODULES = ["fs", "net", "http", "dns", "crypto", "stream", "child_process",
+    "cluster", "dgram", "tls", "zlib", "url", "util", "os", "path", "vm",
+    "readline", "repl", "tty", "events", "buffer", "timers", "domain"]
+VERBS = ["read", "write", "open", "close", "create", "connect", "listen",
+    "resolve", "lookup", "set", "get", "spawn", "exec", "watch", "stat",
+    "chown", "chmod", "rename", "pause", "resume", "pipe", "end", "ref",
+    "unref", "destroy", "format", "parse", "update", "digest", "bind"]
+NOUNS = ["File", "Server", "Socket", "Stream", "Timeout", "Interval",
+    "Buffer", "Address", "Encoding", "Header", "Cipher", "Hash", "Sync",
+    "Link", "Dir", "Watcher", "Context", "Interface", "Worker", "Domain"]
+# Real API names, so that lookups of them (as in "tools/bench.py") hit.
+APIS = ["createServer", "readFile", "writeFile", "stat", "chown", "spawn",
+    "setTimeout", "on", "once", "end", "write", "pipe"]
+EVENTS = ["close", "data", "end", "error", "connection", "listening",
+    "message", "exit", "drain", "timeout", "change", "line", "finish"]
+ARGS = ["path", "fd", "options", "callback", "buffer", "offset", "length",
+    "position", "encoding", "mode", "uid", "gid", "port", "host", "data",
+    "listener", "delay", "signal", "flags", "backlog", "chunk", "name"]
+WORDS = """the a an of to in is for that with on as by be this are from
+or it can will if when not all which each its object function event
+returns emitted called value default string number argument data stream
+server socket file buffer error callback process module connection
+request response options method property specified given new used first
+time see instance created note example following system node""".split()
+URLS = ["http://nodejs.org/", "http://en.wikipedia.org/wiki/Unix",
+    "http://tools.ietf.org/html/rfc2616", "http://www.openssl.org/docs/",
+    "http://man7.org/linux/man-pages/", "https://github.com/joyent/node"]
+STABILITY = ["0 - Deprecated", "1 - Experimental", "2 - Unstable",
+    "3 - Stable", "4 - API Frozen", "5 - Locked"]
+
+class Error(Exception):
+    pass
+
+
+
+#---- main functionality
+
+class _SectionWriter(object):
+    """Writes the markdown for one synthetic doc section."""
+    def __init__(self, rng, name, num_apis):
+        self.rng = rng
+        self.name = name
+        self.num_apis = num_apis
+        self.links = {}     # link definitions used in the section
+        self.lines = []
+
+    def write(self):
+        rng = self.rng
+        self.lines += ["# " + self.name.replace("_", " ").title(), "",
+            "    Stability: " + rng.choice(STABILITY), ""]
+        self.paragraphs(rng.randint(1, 3))
+        self.code_block()
+        apis = 0
+        while apis < self.num_apis:
+            if rng.random() < 0.2:
+                apis += self.klass(min(self.num_apis - apis - 1,
+                    rng.randint(3, 10)))
+            else:
+                self.function("%s.%s" % (self.name, self.method_name()), "##")
+            apis += 1
+        for text, url in sorted(self.links.items()):
+            self.lines.append("[%s]: %s" % (text, url))
+        return "\n".join(self.lines) + "\n"
+
+    def method_name(self):
+        if self.rng.random() < 0.1:
+            return self.rng.choice(APIS)
+        name = self.rng.choice(VERBS)
+        if self.rng.random() < 0.6:
+            name += self.rng.choice(NOUNS)
+        return name
+
+    def signature(self):
+        args = self.rng.sample(ARGS, self.rng.randint(0, 4))
+        args = [self.rng.random() < 0.3 and "[%s]" % a or a for a in args]
+        return "(%s)" % ", ".join(args)
+
+    def function(self, name, level):
+        self.lines += ["%s %s%s" % (level, name, self.signature()), ""]
+        self.paragraphs(self.rng.randint(1, 3))
+        if self.rng.random() < 0.5:
+            self.code_block()
+        if self.rng.random() < 0.2:
+            self.bullets()
+
+    def klass(self, num_members):
+        rng = self.rng
+        noun = rng.choice(NOUNS)
+        obj = noun[0].lower() + noun[1:]
+        self.lines += ["## Class: %s.%s" % (self.name, noun), ""]
+        self.paragraphs(rng.randint(1, 2))
+        for i in range(num_members):
+            r = rng.random()
+            if r < 0.6:
+                self.function("%s.%s" % (obj, self.method_name()), "###")
+            elif r < 0.85:
+                self.lines += ["### Event: '%s'" % rng.choice(EVENTS), "",
+                    "`function (%s) { }`" % rng.choice(ARGS), ""]
+                self.paragraphs(1)
+            else:
+                self.lines += ["### %s.%s" % (obj, rng.choice(ARGS)), ""]
+                self.paragraphs(1)
+        return num_members
+
+    def sentence(self):
+        rng = self.rng
+        words = []
+        for i in range(rng.randint(6, 20)):
+            r = rng.random()
+            if r < 0.08:
+                words.append("`%s.%s()`" % (self.name, self.method_name()))
+            elif r < 0.1:
+                words.append("`%s`" % rng.choice(ARGS))
+            elif r < 0.12:
+                text = rng.choice(NOUNS)
+                self.links[text] = rng.choice(URLS)
+                words.append("[%s][]" % text)
+            else:
+                words.append(rng.choice(WORDS))
+        text = " ".join(words)
+        return text[0].upper() + text[1:] + "."
+
+    def paragraphs(self, n):
+        for i in range(n):
+            text = " ".join([self.sentence()
+                for j in range(self.rng.randint(1, 3))])
+            # Wrap at 76 columns, as the node docs are.
+            line = ""
+            for word in text.split(" "):
+                if line and len(line) + len(word) >= 76:
+                    self.lines.append(line)
+                    line = word
+                else:
+                    line = line and line + " " + word or word
+            self.lines += [line, ""]
+
+    def bullets(self):
+        for i in range(self.rng.randint(2, 6)):
+            self.lines.append("- `%s`: %s" % (self.rng.choice(ARGS),
+                self.sentence()))
+        self.lines.append("")
+
+    def code_block(self):
+        rng = self.rng
+        var = self.name.replace("_", "")
+        code = ["var %s = require('%s');" % (var, self.name), ""]
+        for i in range(rng.randint(1, 4)):
+            code += ["%s.%s('%s', function (err, %s) {" % (var,
+                    self.method_name(), rng.choice(WORDS), rng.choice(ARGS)),
+                "  if (err) throw err;",
+                "  console.log('%s: ' + %s);" % (rng.choice(WORDS),
+                    rng.choice(ARGS)),
+                "});"]
+        self.lines += ["    " + line if line else "" for line in code]
+        self.lines.append("")
+
+def make_corpus(dir, sections=36, apis=20, seed=0):
+    """Write a synthetic doc tree of `sections` sections, each with about
+    `apis` API headers, to `dir`.
+
+    @returns {list} The paths of the markdown files written.
+    """
+    rng = random.Random(seed)
+    if not exists(dir):
+        os.makedirs(dir)
+    paths = []
+    for i in range(sections):
+        name = MODULES[i % len(MODULES)]
+        if i >= len(MODULES):
+            name += str(i // len(MODULES))
+        path = join(dir, name + ".markdown")
+        f = open(path, 'w')
+        try:
+            f.write(_SectionWriter(rng, name, apis).write())
+        finally:
+            f.close()
+        paths.append(path)
+    return paths
+
+
+
+#---- mainline
+
+def main(argv):
+    parser = optparse.OptionParser(prog="mkcorpus", usage='',
+        description=__doc__)
+    parser.add_option("-n", "--sections", type="int", default=36,
+        help="number of sections (default 36)")
+    parser.add_option("-a", "--apis", type="int", default=20,
+        help="number of API headers per section (default 20)")
+    parser.add_option("--seed", type="int", default=0,
+        help="random seed (default 0)")
+    opts, args = parser.parse_args(argv[1:])
+    try:
+        if len(args) != 1:
+            raise Error("incorrect number of arguments (see `--help`)")
+        paths = make_corpus(args[0], opts.sections, opts.apis, opts.seed)
+        print "wrote %d sections to '%s'" % (len(paths), args[0])
+    except Error, ex:
+        sys.stderr.write("mkcorpus: error: %s\n" % ex)
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))